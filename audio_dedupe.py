@@ -0,0 +1,66 @@
+import sys
+import time
+import argparse
+import multiprocessing
+
+from utils.fingerprint_index import FingerprintIndex
+from utils.hash_index import HashIndex
+from utils.duplicate_finder import DuplicateFinder
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Find clusters of near-duplicate audio files in a given directory.")
+    parser.add_argument("-r", "--root", required=True, help="searching directory")
+    parser.add_argument("-o", "--output", default=None, help="cluster csv, default stdout")
+    parser.add_argument(
+        "-s", "--min-similarity", type=float, default=DuplicateFinder.DEFAULT_MIN_SIMILARITY,
+        help="min share of matched fingerprint cells of the shorter file, 0-1",
+    )
+    parser.add_argument(
+        "--min-vote-ratio", type=float, default=DuplicateFinder.DEFAULT_MIN_VOTE_RATIO,
+        help="min share of hash hits of the shorter file for a candidate pair, 0-1",
+    )
+    parser.add_argument(
+        "--max-candidates", type=int, default=DuplicateFinder.DEFAULT_MAX_CANDIDATES, help="candidates per file"
+    )
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes, default all cpus")
+    parser.add_argument("--index-dir", default=FingerprintIndex.DEFAULT_INDEX_DIR, help="fingerprint index directory")
+    parser.add_argument("--no-index", action="store_true", help="do not load or save the fingerprint index")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    args = parse_args()
+
+    # fingerprint every file once
+    start_time = time.perf_counter()
+    index = FingerprintIndex(args.root)
+    index_dir = None if args.no_index else args.index_dir
+    refresh_report = index.sync(index_dir, n_workers=args.workers)
+    print("Index refresh: %s, %.1fs" % (refresh_report.summary(), time.perf_counter() - start_time), file=sys.stderr)
+    if len(refresh_report.failed) > 0:
+        print(refresh_report.failure_summary(), file=sys.stderr)
+
+    # candidate pairs from hash votes, exact match on them only
+    start_time = time.perf_counter()
+    duplicate_finder = DuplicateFinder(
+        HashIndex.sync(index, index_dir),
+        min_similarity=args.min_similarity,
+        min_vote_ratio=args.min_vote_ratio,
+        max_candidates=args.max_candidates,
+        n_workers=args.workers,
+    )
+    cluster_list, duplicate_pairs = duplicate_finder.find()
+    print("%d duplicate pairs in %d clusters of %d files, %.1fs" % (
+        len(duplicate_pairs), len(cluster_list), len(duplicate_finder.hash_index.paths),
+        time.perf_counter() - start_time,
+    ), file=sys.stderr)
+
+    if args.output is None:
+        duplicate_finder.write_clusters(cluster_list, duplicate_pairs, sys.stdout)
+    else:
+        with open(args.output, "w", newline="") as f:
+            duplicate_finder.write_clusters(cluster_list, duplicate_pairs, f)
+        print("Result saved to '%s'." % args.output, file=sys.stderr)
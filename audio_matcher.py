@@ -1,4 +1,5 @@
 import sys
+import multiprocessing
 
 from PySide6.QtWidgets import QApplication
 from qt_material import build_stylesheet
@@ -7,6 +8,9 @@ from view.main import MainWindow
 
 
 if __name__ == '__main__':
+    # search worker processes in the frozen exe
+    multiprocessing.freeze_support()
+
     # init
     app = QApplication([])
     main_window = MainWindow()
@@ -0,0 +1,61 @@
+import sys
+import json
+import argparse
+import multiprocessing
+import numpy as np
+
+from utils.fingerprint_index import FingerprintIndex
+from utils.hash_index import HashIndex
+from utils.stream_monitor import StreamMonitor
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Recognize library files in a live audio stream.")
+    parser.add_argument("-r", "--root", required=True, help="library directory")
+    parser.add_argument(
+        "-i", "--input", required=True,
+        help="recorded file fed chunk by chunk, or - for raw float32 mono pcm at the library rate on stdin",
+    )
+    parser.add_argument(
+        "--chunk-time", type=float, default=StreamMonitor.DEFAULT_CHUNK_TIME, help="seconds of samples per chunk"
+    )
+    parser.add_argument(
+        "--buffer-time", type=float, default=StreamMonitor.DEFAULT_BUFFER_TIME, help="seconds of stream matched"
+    )
+    parser.add_argument(
+        "-s", "--min-similarity", type=float, default=StreamMonitor.DEFAULT_MIN_SIMILARITY,
+        help="min share of matched fingerprint cells of the shorter of the file and the buffer, 0-1",
+    )
+    parser.add_argument("-j", "--workers", type=int, default=None, help="fingerprinting processes, default all cpus")
+    parser.add_argument("--index-dir", default=FingerprintIndex.DEFAULT_INDEX_DIR, help="fingerprint index directory")
+    parser.add_argument("--no-index", action="store_true", help="do not load or save the fingerprint index")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    args = parse_args()
+
+    # library fingerprints, preloaded before the stream starts
+    index = FingerprintIndex(args.root)
+    index_dir = None if args.no_index else args.index_dir
+    refresh_report = index.sync(index_dir, n_workers=args.workers)
+    print("Index refresh: %s" % refresh_report.summary(), file=sys.stderr)
+    if len(refresh_report.failed) > 0:
+        print(refresh_report.failure_summary(), file=sys.stderr)
+
+    monitor = StreamMonitor(
+        HashIndex.sync(index, index_dir), buffer_time=args.buffer_time, min_similarity=args.min_similarity
+    )
+    if args.input == "-":
+        chunk_bytes = max(int(args.chunk_time * monitor.sample_rate), 1) * np.dtype(np.float32).itemsize
+        detections = (
+            detection
+            for chunk in iter(lambda: sys.stdin.buffer.read(chunk_bytes), b"")
+            for detection in monitor.push(np.frombuffer(chunk[:len(chunk) // 4 * 4], dtype=np.float32))
+        )
+    else:
+        detections = monitor.feed_file(args.input, args.chunk_time)
+    for detection in detections:
+        print(json.dumps(detection.to_dict()), flush=True)
@@ -0,0 +1,171 @@
+import os
+import sys
+import csv
+import json
+import argparse
+import multiprocessing
+
+from utils.audio_loader import LOADER_DICT
+from utils.fingerprint import WavFingerprint
+from utils.fingerprint_index import FingerprintIndex
+from utils.fingerprint_store import FingerprintStore
+from utils.search_engine import SearchEngine
+from utils.pcm_cache import PcmCache
+from utils.profiler import StageProfiler, set_profiler
+from utils.query_cache import get_query_cache
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Search for similar audio files in a given directory.")
+    parser.add_argument("queries", nargs="+", help="query audio files (%s)" % " ".join(LOADER_DICT.keys()))
+    parser.add_argument("-r", "--root", required=True, help="searching directory")
+    parser.add_argument("-k", "--top-k", type=int, default=5, help="results kept per query, 0 for all")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes, default all cpus")
+    parser.add_argument("-f", "--format", choices=["csv", "json"], default="csv", help="output format")
+    parser.add_argument("-o", "--output", default=None, help="output file, default stdout")
+    parser.add_argument("--index-dir", default=FingerprintIndex.DEFAULT_INDEX_DIR, help="fingerprint index directory")
+    parser.add_argument("--no-index", action="store_true", help="do not load or save the fingerprint index")
+    parser.add_argument(
+        "--store-dir", default=None, help="memory-mapped fingerprint store directory, used instead of the index"
+    )
+    parser.add_argument(
+        "--compact-store", action="store_true",
+        help="rewrite the store without replaced and removed records, done anyway once most records are",
+    )
+    parser.add_argument("--pcm-cache", default=None, help="decoded and resampled samples cache directory")
+    parser.add_argument(
+        "--pcm-cache-size", type=int, default=PcmCache.DEFAULT_MAX_BYTES >> 20, help="max samples cache size in MB"
+    )
+    parser.add_argument(
+        "--coarse", action="store_true", help="two stage matching, faster but may miss weak matches"
+    )
+    parser.add_argument(
+        "--peaks", type=int, default=0, help="best matching offsets reported per result, 0 for scores only"
+    )
+    parser.add_argument("--profile", default=None, help="write per-file stage timings to this json file")
+    return parser.parse_args()
+
+
+# {query path: [(path, score, [(offset, start, end, peak score)])]} sorted by score, top_k results of each query
+# peaks are empty unless args.peaks > 0, see WavFingerprint.pick_peaks
+def run_search(args: argparse.Namespace) -> dict[str, list[tuple[str, float, list]]]:
+
+    # query fingerprints
+    profiler = StageProfiler() if args.profile is not None else None
+    set_profiler(profiler)
+    query_fingerprints = []
+    for query_path in args.queries:
+        if profiler is not None:
+            profiler.begin_file(query_path)
+        query_fingerprints.append(get_query_cache().load(query_path, WavFingerprint.DEFAULT_SAMPLE_RATE))
+    set_profiler(None)
+
+    # library files and index, new and changed files are fingerprinted before matching
+    pcm_cache = None
+    if args.pcm_cache is not None:
+        pcm_cache = PcmCache(args.pcm_cache, max_bytes=args.pcm_cache_size << 20)
+    key_paths = FingerprintIndex.scan_files(args.root)
+    index = FingerprintIndex(args.root, pcm_cache=pcm_cache)
+    index_dir = None if args.no_index else args.index_dir
+    store = None
+    if args.store_dir is not None:
+        store = FingerprintStore(args.store_dir)
+        store.open()
+        # a store may hold several roots, only deleted files under this root are removed
+        key_path_set = set(key_paths)
+        store.remove([
+            path for path in store.locations.keys()
+            if path.startswith(index.root + os.sep) and path not in key_path_set
+        ])
+        print("Store: %d stored fingerprints." % len(store.locations), file=sys.stderr)
+    else:
+        refresh_report = index.sync(index_dir, key_paths, n_workers=args.workers, profiler=profiler)
+        print("Index refresh: %s" % refresh_report.summary(), file=sys.stderr)
+        if len(refresh_report.failed) > 0:
+            print(refresh_report.failure_summary(), file=sys.stderr)
+            key_paths = [path for path in key_paths if path not in refresh_report.failed]
+
+    # match all queries in one pass over the library
+    search_engine = SearchEngine(
+        query_fingerprints=query_fingerprints,
+        index=index,
+        n_workers=args.workers,
+        pcm_cache=pcm_cache,
+        top_k=args.top_k if args.top_k > 0 else None,
+        profiler=profiler,
+        store=store,
+        coarse=args.coarse,
+        n_peaks=args.peaks,
+    )
+    result_dict = {query_path: [] for query_path in args.queries}
+    for matched_num, (_, key_path, scores) in enumerate(search_engine.search(key_paths)):
+        print("\r[%d/%d]%s" % (matched_num + 1, len(key_paths), os.path.basename(key_path)), end="", file=sys.stderr)
+        peak_lists = search_engine.file_peaks.get(key_path, [None] * len(scores))
+        for query_path, score, peak_list in zip(args.queries, scores, peak_lists):
+            if score is not None:   # None if skipped by top-k bound
+                result_dict[query_path].append((key_path, score, peak_list or []))
+    print(file=sys.stderr)
+    for key_path, error in search_engine.failed_paths.items():
+        print("[WARNING]Skipped '%s': %s" % (key_path, error), file=sys.stderr)
+
+    if store is not None and (args.compact_store or store.needs_compact()):
+        print("Store: compacting %d dead records." % store.n_dead_records(), file=sys.stderr)
+        store.compact()
+    if store is None and index_dir is not None and index.modified:     # files changed since the refresh
+        index.save(FingerprintIndex.default_index_path(args.root, index_dir))
+
+    if profiler is not None:
+        print(profiler.summary(), file=sys.stderr)
+        profiler.dump(args.profile)
+
+    for query_path, result_list in result_dict.items():
+        result_list.sort(key=lambda r: r[1], reverse=True)
+        if args.top_k > 0:
+            del result_list[args.top_k:]
+    return result_dict
+
+
+# csv has one row per peak when peaks were searched, offsets and time ranges in seconds
+def write_result(result_dict: dict[str, list[tuple[str, float, list]]], output_format: str, f):
+    if output_format == "json":
+        json.dump({
+            query_path: [{
+                "path": path,
+                "score": score,
+                "peaks": [
+                    {"offset": offset, "start": start, "end": end, "score": peak_score}
+                    for offset, start, end, peak_score in peak_list
+                ],
+            } for path, score, peak_list in result_list]
+            for query_path, result_list in result_dict.items()
+        }, f, indent=2)
+        print(file=f)
+        return
+
+    with_peaks = any([len(peak_list) > 0 for result_list in result_dict.values() for _, _, peak_list in result_list])
+    writer = csv.writer(f, lineterminator="\n")
+    peak_columns = ["Offset", "Start", "End", "PeakScore"] if with_peaks else []
+    writer.writerow(["Query", "Rank", "Path", "Score"] + peak_columns)
+    for query_path, result_list in result_dict.items():
+        for rank, (path, score, peak_list) in enumerate(result_list):
+            row = [query_path, rank + 1, path, "%d" % score]
+            if not with_peaks:
+                writer.writerow(row)
+                continue
+            for offset, start, end, peak_score in peak_list or [(None, None, None, None)]:
+                writer.writerow(row + (["", "", "", ""] if offset is None else [
+                    "%.2f" % offset, "%.2f" % start, "%.2f" % end, "%d" % peak_score
+                ]))
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    args = parse_args()
+    result_dict = run_search(args)
+    if args.output is None:
+        write_result(result_dict, args.format, sys.stdout)
+    else:
+        with open(args.output, "w", newline="") as f:
+            write_result(result_dict, args.format, f)
+        print("Result saved to '%s'." % args.output, file=sys.stderr)
@@ -0,0 +1,43 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import multiprocessing
+
+from utils.fingerprint_index import FingerprintIndex
+from utils.search_server import SearchServer, request_server
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve searches over one directory, or query a running server.")
+    parser.add_argument("-r", "--root", default=None, help="searching directory, starts a server")
+    parser.add_argument("-q", "--query", nargs="+", default=[], help="query files sent to a running server")
+    parser.add_argument("-k", "--top-k", type=int, default=SearchServer.DEFAULT_TOP_K, help="results per query")
+    parser.add_argument("--refresh", action="store_true", help="ask a running server to rescan its directory")
+    parser.add_argument("--host", default=SearchServer.DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=SearchServer.DEFAULT_PORT)
+    parser.add_argument("-j", "--workers", type=int, default=None, help="fingerprinting processes, default all cpus")
+    parser.add_argument("-t", "--threads", type=int, default=os.cpu_count(), help="concurrent queries")
+    parser.add_argument("--index-dir", default=FingerprintIndex.DEFAULT_INDEX_DIR, help="fingerprint index directory")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    args = parse_args()
+    if args.root is not None:
+        server = SearchServer(args.root, index_dir=args.index_dir, n_workers=args.workers, n_threads=args.threads)
+        try:
+            asyncio.run(server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    requests = [{"query": os.path.abspath(query_path), "top_k": args.top_k} for query_path in args.query]
+    if args.refresh:
+        requests.insert(0, {"command": "refresh"})
+    for request in requests:
+        for answer_line in request_server(request, args.host, args.port):
+            print(json.dumps(answer_line))
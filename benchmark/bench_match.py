@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.fingerprint import WavFingerprint
+
+
+# (query seconds, key seconds)
+LENGTH_CASES = [
+    (1.0, 2.0),
+    (1.0, 10.0),
+    (3.0, 30.0),
+    (5.0, 60.0),
+    (10.0, 10.0),
+]
+SAMPLE_RATE = WavFingerprint.DEFAULT_SAMPLE_RATE
+REFERENCE_TIMEOUT = 60.0    # skip reference loop if it is estimated to exceed this (seconds)
+
+
+# per-offset loop matcher before vectorization, used as the baseline and to check results
+def reference_match(wav_a: WavFingerprint, wav_b: WavFingerprint, max_offsets: int = None) -> np.ndarray:
+    if wav_a.n_window > wav_b.n_window:
+        wav_a, wav_b = wav_b, wav_a
+    fingerprint_a = wav_a.fingerprint
+    fingerprint_b = wav_b.fingerprint
+    pad_len = fingerprint_a.shape[0] // 2
+    fingerprint_b = np.pad(
+        fingerprint_b,
+        ((pad_len, pad_len), (0, 0), (0, 0), (0, 0)),
+    )
+    conv_len = fingerprint_b.shape[0] - fingerprint_a.shape[0] + 1
+    if max_offsets is not None:
+        conv_len = min(conv_len, max_offsets)
+    similarity_array = np.zeros((conv_len,))
+    for pos_idx in range(conv_len):
+        distance = np.linalg.norm(fingerprint_a - fingerprint_b[pos_idx:pos_idx + fingerprint_a.shape[0]], axis=3)
+        similarity_array[pos_idx] = np.sum(np.array(distance < 1e-6, dtype=np.int32))
+    return similarity_array
+
+
+# tonal noise, so octave peaks repeat between query and key
+def synth_samples(duration: float, rng: np.random.Generator, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    n_samples = int(duration * sample_rate)
+    t = np.arange(n_samples) / sample_rate
+    freqs = rng.uniform(220, 8000, size=4)
+    samples = sum(np.sin(2 * np.pi * f * t) for f in freqs)
+    return samples + 0.1 * rng.standard_normal(n_samples)
+
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(0)
+    print("%-10s %-10s %-12s %-12s %-10s %s" % ("query(s)", "key(s)", "loop(s)", "batched(s)", "speedup", "same"))
+    for query_time, key_time in LENGTH_CASES:
+        key_samples = synth_samples(key_time, rng)
+        query_start = int(0.25 * (key_time - query_time) * SAMPLE_RATE)
+        query_samples = key_samples[query_start:query_start + int(query_time * SAMPLE_RATE)]
+        query = WavFingerprint(query_samples, SAMPLE_RATE)
+        key = WavFingerprint(key_samples, SAMPLE_RATE)
+
+        start_time = time.perf_counter()
+        scores = WavFingerprint.match(query, key)
+        batched_time = time.perf_counter() - start_time
+
+        # time a few offsets of the reference loop and extrapolate if the full run is too slow
+        n_probe = min(len(scores), 20)
+        start_time = time.perf_counter()
+        reference_match(query, key, max_offsets=n_probe)
+        loop_time = (time.perf_counter() - start_time) / n_probe * len(scores)
+        if loop_time < REFERENCE_TIMEOUT:
+            start_time = time.perf_counter()
+            reference_scores = reference_match(query, key)
+            loop_time = time.perf_counter() - start_time
+            same = str(np.array_equal(scores, reference_scores))
+        else:
+            same = str(np.array_equal(scores[:n_probe], reference_match(query, key, max_offsets=n_probe))) + "*"
+
+        print("%-10.1f %-10.1f %-12.3f %-12.4f %-10.1f %s" % (
+            query_time, key_time, loop_time, batched_time, loop_time / batched_time, same
+        ))
+
+    print("* loop time extrapolated, results compared on the first offsets only")
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.fingerprint import WavFingerprint
+from utils.fingerprint_index import FingerprintIndex, IndexEntry
+from utils.hash_index import HashIndex
+from utils.stream_monitor import StreamMonitor
+from bench_match import synth_samples
+
+
+SAMPLE_RATE = WavFingerprint.DEFAULT_SAMPLE_RATE
+LIBRARY_FILES = 20
+CLIP_DURATION = (1.0, 2.5)      # seconds, min and max of the library files
+LEAD_TIME = 0.4                 # seconds of stream noise before the clip starts
+NOISE_LEVEL = 0.01
+# (library file, samples the clip starts after a multiple of the window), the monitor grid starts on the first sample
+CASES = [(7, 0), (7, 100), (7, 441), (11, 13), (11, 600), (2, 257), (2, 881)]
+
+
+# library of synthetic files -> (samples of each file, hash index)
+def synth_library(rng: np.random.Generator) -> tuple[list[np.ndarray], HashIndex]:
+    index = FingerprintIndex(os.path.join("bench_monitor", "library"))
+    clips = []
+    for file_idx in range(LIBRARY_FILES):
+        samples = synth_samples(rng.uniform(*CLIP_DURATION), rng)
+        fingerprint = WavFingerprint(WavFingerprint.trim_silence(samples), SAMPLE_RATE, compact=True)
+        path = os.path.abspath(os.path.join(index.root, "clip_%03d.wav" % file_idx))
+        index.entries[path] = IndexEntry(
+            path=path, size=0, mtime_ns=0, n_window=fingerprint.n_window, feature=fingerprint.feature
+        )
+        clips.append(samples)
+    return clips, HashIndex.from_fingerprint_index(index)
+
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(5)
+    clips, hash_index = synth_library(rng)
+    chunk_len = int(StreamMonitor.DEFAULT_CHUNK_TIME * SAMPLE_RATE)
+    n_samples_per_window = int(WavFingerprint.WINDOW_TIME * SAMPLE_RATE)
+    n_missed = 0
+    print("%-6s %-8s %-10s %-14s %-12s %-12s %s" % (
+        "file", "shift", "detected", "start err(ms)", "similarity", "latency(s)", "time/audio"
+    ))
+    for file_idx, shift in CASES:
+        onset = int(LEAD_TIME * SAMPLE_RATE) // n_samples_per_window * n_samples_per_window + shift
+        stream = np.concatenate([
+            NOISE_LEVEL * rng.standard_normal(onset),
+            clips[file_idx],
+            NOISE_LEVEL * rng.standard_normal(int(StreamMonitor.DEFAULT_BUFFER_TIME * SAMPLE_RATE)),
+        ])
+
+        monitor = StreamMonitor(hash_index)
+        detection = None
+        start_time = time.perf_counter()
+        for chunk_start in range(0, stream.shape[0], chunk_len):
+            for chunk_detection in monitor.push(stream[chunk_start:chunk_start + chunk_len]):
+                if detection is None and chunk_detection.path == hash_index.paths[file_idx]:
+                    detection = chunk_detection
+        run_time = time.perf_counter() - start_time
+
+        if detection is None:
+            n_missed += 1
+            print("%-6d %-8d %-10s %-14s %-12s %-12s %.3f" % (
+                file_idx, shift, "False", "-", "-", "-", run_time / (stream.shape[0] / SAMPLE_RATE)
+            ))
+            continue
+        print("%-6d %-8d %-10s %-14.2f %-12.3f %-12.2f %.3f" % (
+            file_idx, shift, "True",
+            (detection.start_time - onset / SAMPLE_RATE) * 1000, detection.similarity,
+            detection.detect_time - onset / SAMPLE_RATE, run_time / (stream.shape[0] / SAMPLE_RATE),
+        ))
+
+    if n_missed > 0:
+        print("%d of %d clips not detected" % (n_missed, len(CASES)))
+        sys.exit(1)
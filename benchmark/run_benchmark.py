@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import soundfile as sf
+import numpy as np
+from typing import Optional, Callable
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.fingerprint import WavFingerprint
+from utils.search_engine import SearchEngine
+from bench_match import synth_samples
+
+try:
+    import resource
+except ImportError:     # windows
+    resource = None
+
+
+REGRESSION_RATIO = 1.2      # compare: stage time above old * ratio is a regression
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark fingerprinting, matching and search.")
+    parser.add_argument("-n", "--files", type=int, default=50, help="corpus file num")
+    parser.add_argument("-d", "--duration", type=float, default=5.0, help="corpus file duration in seconds")
+    parser.add_argument("-c", "--channels", type=int, default=2, help="corpus channel num")
+    parser.add_argument("-s", "--sample-rate", type=int, default=48000, help="corpus sample rate")
+    parser.add_argument("-q", "--query-duration", type=float, default=1.0, help="query duration in seconds")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="search worker processes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default=None, help="json result path, default stdout")
+    parser.add_argument("--compare", default=None, help="json result of another commit to compare with")
+    return parser.parse_args()
+
+
+# peak resident set size in MB of this process, or of the largest finished child process, None if unavailable
+def peak_rss_mb(children: bool = False) -> Optional[float]:
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin":
+        return peak_rss / (1 << 20)     # bytes
+    return peak_rss / (1 << 10)         # KB
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# write synthetic corpus into corpus_dir -> file paths
+def generate_corpus(corpus_dir: str, args: argparse.Namespace, rng: np.random.Generator) -> list[str]:
+    paths = []
+    for file_idx in range(args.files):
+        samples = np.stack([
+            synth_samples(args.duration, rng, args.sample_rate) for _ in range(args.channels)
+        ], axis=1)
+        samples *= 0.9 / np.max(np.abs(samples))
+        path = os.path.join(corpus_dir, "sample_%05d.wav" % file_idx)
+        sf.write(path, samples, args.sample_rate)
+        paths.append(path)
+    return paths
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.stages: dict[str, dict] = {}
+
+    # record a stage over n_files files with audio_seconds of audio
+    # worker rss is the peak of the largest search worker, the pool is joined by then
+    def add(self, stage: str, seconds: float, n_files: int, audio_seconds: float):
+        self.stages[stage] = {
+            "seconds": seconds,
+            "files_per_second": n_files / seconds if seconds > 0 else None,
+            "audio_seconds_per_second": audio_seconds / seconds if seconds > 0 else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_worker_rss_mb": peak_rss_mb(children=True),
+        }
+
+    # time stage_func over all inputs after an untimed warm-up run on the first one,
+    # so first call costs, e.g. lazy imports and caches of librosa, do not dominate short runs -> outputs
+    def measure(self, stage: str, stage_func: Callable[[list], list], inputs: list, audio_seconds: float) -> list:
+        stage_func(inputs[:1])
+        start_time = time.perf_counter()
+        outputs = stage_func(inputs)
+        self.add(stage, time.perf_counter() - start_time, len(inputs), audio_seconds)
+        return outputs
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    rng = np.random.default_rng(args.seed)
+    corpus_dir = tempfile.mkdtemp(prefix="audio_search_bench_")
+    timer = StageTimer()
+    try:
+        paths = generate_corpus(corpus_dir, args, rng)
+        n_files = len(paths)
+        audio_seconds = n_files * args.duration     # first channel of each file
+
+        # load
+        loaded = timer.measure(
+            "load", lambda stage_paths: [sf.read(path, always_2d=True) for path in stage_paths], paths, audio_seconds
+        )
+
+        # trim silence
+        trimmed = timer.measure(
+            "trim_silence",
+            lambda stage_loaded: [WavFingerprint.trim_silence(samples[:, 0]) for samples, _ in stage_loaded],
+            loaded,
+            audio_seconds,
+        )
+
+        # resample
+        resampled = timer.measure(
+            "resample",
+            lambda stage_inputs: [
+                WavFingerprint.resample(samples, sample_rate, WavFingerprint.DEFAULT_SAMPLE_RATE)
+                for samples, sample_rate in stage_inputs
+            ],
+            [(samples, sample_rate) for samples, (_, sample_rate) in zip(trimmed, loaded)],
+            audio_seconds,
+        )
+        del loaded, trimmed
+
+        # fingerprint
+        key_fingerprints = timer.measure(
+            "fingerprint",
+            lambda stage_resampled: [
+                WavFingerprint(samples, WavFingerprint.DEFAULT_SAMPLE_RATE, compact=True) for samples in stage_resampled
+            ],
+            resampled,
+            audio_seconds,
+        )
+
+        # match, query is an excerpt of the first file
+        query_len = int(args.query_duration * WavFingerprint.DEFAULT_SAMPLE_RATE)
+        query_fingerprint = WavFingerprint(resampled[0][:query_len], WavFingerprint.DEFAULT_SAMPLE_RATE, compact=True)
+        del resampled
+        timer.measure(
+            "match",
+            lambda stage_keys: [
+                WavFingerprint.match(query_fingerprint, key_fingerprint) for key_fingerprint in stage_keys
+            ],
+            key_fingerprints,
+            audio_seconds,
+        )
+
+        # end to end search of all channels of the query file, no index
+        query_fingerprints = WavFingerprint.from_samples(
+            sf.read(paths[0], frames=int(args.query_duration * args.sample_rate), always_2d=True)[0],
+            args.sample_rate,
+            resample_rate=WavFingerprint.DEFAULT_SAMPLE_RATE,
+            compact=True,
+        )
+        search_engine = SearchEngine([query_fingerprints], n_workers=args.workers)
+        timer.measure("search", lambda stage_paths: list(search_engine.search(stage_paths)), paths, audio_seconds)
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "config": {
+            "files": args.files,
+            "duration": args.duration,
+            "channels": args.channels,
+            "sample_rate": args.sample_rate,
+            "query_duration": args.query_duration,
+            "workers": search_engine.n_workers,
+        },
+        "stages": timer.stages,
+    }
+
+
+# print stage time ratios -> True if any stage regressed
+def compare_result(result: dict, old_result: dict) -> bool:
+    if result["config"] != old_result["config"]:
+        print("[WARNING]Configs differ: %s vs %s" % (result["config"], old_result["config"]), file=sys.stderr)
+    regressed = False
+    print("%-14s %-10s %-10s %s" % ("stage", "old(s)", "new(s)", "new/old"), file=sys.stderr)
+    for stage, stage_result in result["stages"].items():
+        old_stage_result = old_result["stages"].get(stage)
+        if old_stage_result is None:
+            continue
+        ratio = stage_result["seconds"] / max(old_stage_result["seconds"], 1e-9)
+        flag = ""
+        if ratio > REGRESSION_RATIO:
+            flag = "  REGRESSION"
+            regressed = True
+        print("%-14s %-10.4f %-10.4f %.2f%s" % (
+            stage, old_stage_result["seconds"], stage_result["seconds"], ratio, flag
+        ), file=sys.stderr)
+    return regressed
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    result = run_benchmark(args)
+
+    result_json = json.dumps(result, indent=2)
+    if args.output is None:
+        print(result_json)
+    else:
+        with open(args.output, "w") as f:
+            print(result_json, file=f)
+        print("Result saved to '%s'." % args.output, file=sys.stderr)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            old_result = json.load(f)
+        sys.exit(1 if compare_result(result, old_result) else 0)
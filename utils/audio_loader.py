@@ -1,6 +1,13 @@
+import os
+import re
+import struct
+import subprocess
 import soundfile as sf
 import numpy as np
-import moviepy.editor
+import imageio_ffmpeg
+from typing import Callable, Iterator, Optional
+
+from .profiler import profile_count
 
 
 class AudioData(object):
@@ -24,18 +31,197 @@ class AudioData(object):
         return self.samples.shape[0] / self.sample_rate
 
 
+# Header metadata of an audio or video file, read without decoding samples
+class AudioInfo(object):
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: int,
+        channels: int,
+        duration: float,    # seconds
+    ):
+        self.path: str = path
+        self.sample_rate: int = sample_rate
+        self.channels: int = channels
+        self.duration: float = duration
+
+
 def soundfile_loader(path: str) -> AudioData:
     samples, sample_rate = sf.read(path, always_2d=True)
     return AudioData(path=path, sample_rate=sample_rate, samples=samples)
 
 
-def moviepy_loader(path: str) -> AudioData:
-    video_clip = moviepy.editor.VideoFileClip(path)
-    samples = video_clip.audio.to_soundarray()
-    if len(samples.shape) < 2:
-        samples = samples[:, np.newaxis]
-    return AudioData(
-        path=path,
-        sample_rate=video_clip.audio.fps,
-        samples=samples
+# Audio only decoder of container formats, ffmpeg writes float32 wav to a pipe which is read block by block
+# video, subtitle and data streams are not decoded
+class FfmpegDecoder(object):
+
+    DEFAULT_BLOCK_FRAMES = 1 << 16      # frames read from the pipe per block
+    PIPE_BUFFER_SIZE = 1 << 20
+    WAVE_FORMAT_IEEE_FLOAT = 3
+    WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+    DURATION_PATTERN = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+    def __init__(
+        self,
+        path: str,
+        channel: Optional[int] = None,
+        block_frames: int = DEFAULT_BLOCK_FRAMES,
+        header_only: bool = False,
+    ):
+        self.path: str = path
+        self.channel: Optional[int] = channel      # decode only this channel, None for all
+        self.block_frames: int = block_frames
+        self.header_only: bool = header_only        # write the wav header without decoding any sample
+        self.sample_rate: int = 0
+        self.channels: int = 0
+        self.log: str = ""      # ffmpeg stderr, available after exit
+        self._process: Optional[subprocess.Popen] = None
+
+    def command(self) -> list[str]:
+        command = [
+            imageio_ffmpeg.get_ffmpeg_exe(), "-nostdin", "-v", "info" if self.header_only else "error",
+            "-i", self.path, "-map", "0:a:0", "-vn", "-sn", "-dn",
+        ]
+        if self.header_only:
+            command += ["-t", "0"]
+        if self.channel is not None:
+            command += ["-af", "pan=mono|c0=c%d" % self.channel]
+        return command + ["-acodec", "pcm_f32le", "-f", "wav", "-"]
+
+    def __enter__(self) -> "FfmpegDecoder":
+        self._process = subprocess.Popen(
+            self.command(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=FfmpegDecoder.PIPE_BUFFER_SIZE,
+        )
+        # __exit__ is not called when __enter__ raises, so the process and its pipes are released here
+        try:
+            self._read_header()
+        except BaseException:
+            self._process.kill()
+            self._process.wait()
+            self._process.stdout.close()
+            self._process.stderr.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._process.stdout.close()
+        if exc_type is not None:
+            self._process.kill()
+        self.log = self._process.stderr.read().decode(errors="replace")
+        self._process.stderr.close()
+        if self._process.wait() != 0 and exc_type is None:
+            raise RuntimeError("ffmpeg failed on '%s': %s" % (self.path, self.log.strip()))
+
+    def _read_exact(self, n_bytes: int) -> bytes:
+        data = self._process.stdout.read(n_bytes)
+        if len(data) < n_bytes:
+            raise RuntimeError("Unexpected end of ffmpeg output of '%s'." % self.path)
+        return data
+
+    # parse riff chunks up to the data chunk, whose size is unknown on a pipe
+    def _read_header(self):
+        try:
+            riff, _, wave = struct.unpack("<4sI4s", self._read_exact(12))
+        except RuntimeError:
+            self._process.wait()
+            raise RuntimeError("ffmpeg failed on '%s': %s" % (
+                self.path, self._process.stderr.read().decode(errors="replace").strip()
+            ))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise RuntimeError("Invalid ffmpeg output of '%s'." % self.path)
+        while True:
+            chunk_id, chunk_size = struct.unpack("<4sI", self._read_exact(8))
+            if chunk_id == b"data":
+                break
+            chunk = self._read_exact(chunk_size + chunk_size % 2)
+            if chunk_id == b"fmt ":
+                format_tag, self.channels, self.sample_rate = struct.unpack("<HHI", chunk[:8])
+                if format_tag not in [FfmpegDecoder.WAVE_FORMAT_IEEE_FLOAT, FfmpegDecoder.WAVE_FORMAT_EXTENSIBLE]:
+                    raise RuntimeError("Unexpected ffmpeg sample format of '%s'." % self.path)
+
+    # float32 blocks of shape (n, channels)
+    def blocks(self) -> Iterator[np.ndarray]:
+        frame_bytes = 4 * self.channels
+        remainder = b""
+        while True:
+            data = self._process.stdout.read(self.block_frames * frame_bytes)
+            if not data:
+                break
+            data = remainder + data
+            n_frames = len(data) // frame_bytes
+            remainder = data[n_frames * frame_bytes:]
+            if n_frames == 0:
+                continue
+            profile_count("decoded_bytes", n_frames * frame_bytes)
+            yield np.frombuffer(data[:n_frames * frame_bytes], dtype="<f4").reshape(n_frames, self.channels)
+
+    # decode path -> (samples of shape (n, channels), sample rate)
+    @staticmethod
+    def read(path: str, channel: Optional[int] = None) -> tuple[np.ndarray, int]:
+        with FfmpegDecoder(path, channel=channel) as decoder:
+            blocks = list(decoder.blocks())
+            samples = np.concatenate(blocks) if blocks else np.zeros((0, decoder.channels), dtype=np.float32)
+        return samples, decoder.sample_rate
+
+    # container header -> AudioInfo, the duration is the container duration, 0.0 if unknown
+    @staticmethod
+    def probe(path: str) -> AudioInfo:
+        with FfmpegDecoder(path, header_only=True) as decoder:
+            for _ in decoder.blocks():
+                pass
+        duration = 0.0
+        match = FfmpegDecoder.DURATION_PATTERN.search(decoder.log)
+        if match is not None:
+            duration = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+        return AudioInfo(path=path, sample_rate=decoder.sample_rate, channels=decoder.channels, duration=duration)
+
+
+def ffmpeg_loader(path: str) -> AudioData:
+    samples, sample_rate = FfmpegDecoder.read(path)
+    return AudioData(path=path, sample_rate=sample_rate, samples=samples.astype(np.float64))
+
+
+# Loader for different ext
+LOADER_DICT: dict[str, Callable[[str], AudioData]] = {
+    ".wav": soundfile_loader,
+    ".mp3": soundfile_loader,
+    ".mov": ffmpeg_loader,
+    ".mp4": ffmpeg_loader,
+    ".avi": ffmpeg_loader,
+    ".flv": ffmpeg_loader,
+    ".mkv": ffmpeg_loader,
+}
+
+
+def is_supported(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in LOADER_DICT
+
+
+# load path with the loader of its ext
+def load_audio(path: str) -> AudioData:
+    return LOADER_DICT[os.path.splitext(path)[1].lower()](path)
+
+
+# channels, sample rate and duration of path from its header only
+def probe_audio(path: str) -> AudioInfo:
+    if LOADER_DICT[os.path.splitext(path)[1].lower()] is ffmpeg_loader:
+        return FfmpegDecoder.probe(path)
+    info = sf.info(path)
+    return AudioInfo(
+        path=path, sample_rate=info.samplerate, channels=info.channels, duration=info.frames / info.samplerate
     )
+
+
+# decode a single channel of path -> (1d samples, sample rate), containers decode only that channel
+def load_audio_channel(path: str, channel: int = 0) -> tuple[np.ndarray, int]:
+    if LOADER_DICT[os.path.splitext(path)[1].lower()] is ffmpeg_loader:
+        samples, sample_rate = FfmpegDecoder.read(path, channel=channel)
+        return samples[:, 0].astype(np.float64), sample_rate
+    samples, sample_rate = sf.read(path, always_2d=True)
+    profile_count("decoded_bytes", samples.nbytes)
+    return samples[:, channel], sample_rate
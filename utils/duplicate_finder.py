@@ -0,0 +1,153 @@
+import os
+import csv
+import multiprocessing
+import numpy as np
+from typing import Optional, Iterator
+
+from .fingerprint import WavFingerprint
+from .hash_index import HashIndex
+
+
+# features of all library files in the current worker process, set by _init_pair_worker
+_worker_hash_index: Optional[HashIndex] = None
+
+
+def _init_pair_worker(
+    sample_rate: int, paths: list[str], n_windows: np.ndarray, feature_offsets: np.ndarray, features: np.ndarray
+):
+    global _worker_hash_index
+    _worker_hash_index = HashIndex(sample_rate)
+    _worker_hash_index.paths = paths
+    _worker_hash_index.n_windows = n_windows
+    _worker_hash_index.feature_offsets = feature_offsets
+    _worker_hash_index.features = features
+
+
+# task: (file id a, file id b, min similarity) -> (file id a, file id b, similarity or None if below min similarity)
+def _score_pair(hash_index: HashIndex, task: tuple[int, int, float]) -> tuple[int, int, Optional[float]]:
+    file_id_a, file_id_b, min_similarity = task
+    return file_id_a, file_id_b, DuplicateFinder.similarity(
+        hash_index.fingerprint(file_id_a), hash_index.fingerprint(file_id_b), min_similarity
+    )
+
+
+# pool task of a pair, see _score_pair
+def _score_pair_task(task: tuple[int, int, float]) -> tuple[int, int, Optional[float]]:
+    return _score_pair(_worker_hash_index, task)
+
+
+# Self-join of one library: every file is fingerprinted once, hash index votes give candidate pairs,
+# only those are matched exactly, pairs above min_similarity are grouped into duplicate clusters
+class DuplicateFinder(object):
+
+    DEFAULT_MIN_SIMILARITY = 0.5
+    DEFAULT_MIN_VOTE_RATIO = 0.15   # offset consistent hash hits over the hashes of the shorter file of a candidate
+    DEFAULT_MAX_CANDIDATES = 50     # candidates of each file, by votes
+    DEFAULT_CHUNK_SIZE = 64         # pairs handed to a worker at once
+
+    def __init__(
+        self,
+        hash_index: HashIndex,
+        min_similarity: float = DEFAULT_MIN_SIMILARITY,
+        min_vote_ratio: float = DEFAULT_MIN_VOTE_RATIO,
+        max_candidates: int = DEFAULT_MAX_CANDIDATES,
+        n_workers: Optional[int] = None,
+    ):
+        self.hash_index: HashIndex = hash_index
+        self.min_similarity: float = min_similarity
+        self.min_vote_ratio: float = min_vote_ratio
+        self.max_candidates: int = max_candidates
+        self.n_workers: int = n_workers if n_workers is not None else os.cpu_count()
+
+    # best match score of a and b over the score of a perfect match of the shorter one, in [0, 1]
+    # None if it is not above min_similarity, offsets that cannot reach it are skipped
+    @staticmethod
+    def similarity(
+        fingerprint_a: WavFingerprint, fingerprint_b: WavFingerprint, min_similarity: float = -1.0
+    ) -> Optional[float]:
+        n_rows = min(fingerprint_a.feature.shape[0], fingerprint_b.feature.shape[0])
+        n_rows -= WavFingerprint.MATCH_WINDOW_NUM - 1
+        full_score = float(n_rows * WavFingerprint.OCTAVE_NUM * WavFingerprint.OCTAVE_NUM)
+        score = WavFingerprint.match_max(fingerprint_a, fingerprint_b, min_similarity * full_score)
+        if score is None:
+            return None
+        return score / full_score
+
+    # (file id a, file id b) with a < b, of the files voting for each other
+    def candidate_pairs(self) -> list[tuple[int, int]]:
+        n_hashes = np.diff(self.hash_index.feature_offsets) - WavFingerprint.MATCH_WINDOW_NUM + 1
+        n_hashes *= WavFingerprint.OCTAVE_NUM
+        pairs = set()
+        for file_id in range(len(self.hash_index.paths)):
+            file_votes = self.hash_index.vote(self.hash_index.fingerprint(file_id))
+            file_votes.pop(file_id, None)
+            candidate_list = sorted([
+                (other_id, votes) for other_id, votes in file_votes.items()
+                if votes >= self.min_vote_ratio * min(n_hashes[file_id], n_hashes[other_id])
+            ], key=lambda c: c[1], reverse=True)[:self.max_candidates]
+            pairs.update([(min(file_id, other_id), max(file_id, other_id)) for other_id, _ in candidate_list])
+        return sorted(pairs)
+
+    # exact similarity of pairs on a process pool -> (file id a, file id b, similarity) above min_similarity
+    def score_pairs(self, pairs: list[tuple[int, int]]) -> Iterator[tuple[int, int, float]]:
+        tasks = [(file_id_a, file_id_b, self.min_similarity) for file_id_a, file_id_b in pairs]
+        init_args = (
+            self.hash_index.sample_rate, self.hash_index.paths, self.hash_index.n_windows,
+            self.hash_index.feature_offsets, self.hash_index.features,
+        )
+        # in process, pairs are scored on the index of this finder, concurrent finders do not share the worker index
+        if self.n_workers <= 1:
+            for task in tasks:
+                file_id_a, file_id_b, similarity = _score_pair(self.hash_index, task)
+                if similarity is not None:
+                    yield file_id_a, file_id_b, similarity
+            return
+
+        with multiprocessing.Pool(self.n_workers, initializer=_init_pair_worker, initargs=init_args) as pool:
+            for file_id_a, file_id_b, similarity in pool.imap_unordered(
+                _score_pair_task, tasks, chunksize=DuplicateFinder.DEFAULT_CHUNK_SIZE
+            ):
+                if similarity is not None:
+                    yield file_id_a, file_id_b, similarity
+
+    # connected components of the duplicate pairs, clusters of 2+ files sorted by size
+    @staticmethod
+    def clusters(n_files: int, pairs: list[tuple[int, int, float]]) -> list[list[int]]:
+        parents = list(range(n_files))
+
+        def find_root(file_id: int) -> int:
+            while parents[file_id] != file_id:
+                parents[file_id] = parents[parents[file_id]]
+                file_id = parents[file_id]
+            return file_id
+
+        for file_id_a, file_id_b, _ in pairs:
+            root_a, root_b = find_root(file_id_a), find_root(file_id_b)
+            if root_a != root_b:
+                parents[max(root_a, root_b)] = min(root_a, root_b)
+
+        cluster_dict: dict[int, list[int]] = {}
+        for file_id in range(n_files):
+            cluster_dict.setdefault(find_root(file_id), []).append(file_id)
+        cluster_list = [cluster for cluster in cluster_dict.values() if len(cluster) > 1]
+        cluster_list.sort(key=lambda c: (-len(c), c[0]))
+        return cluster_list
+
+    # -> (clusters of file ids, duplicate pairs with their similarity)
+    def find(self) -> tuple[list[list[int]], list[tuple[int, int, float]]]:
+        pairs = list(self.score_pairs(self.candidate_pairs()))
+        pairs.sort()
+        return DuplicateFinder.clusters(len(self.hash_index.paths), pairs), pairs
+
+    # one row per clustered file with its best similarity to another file of the cluster
+    def write_clusters(self, cluster_list: list[list[int]], pairs: list[tuple[int, int, float]], f):
+        best_similarity: dict[int, float] = {}
+        for file_id_a, file_id_b, similarity in pairs:
+            for file_id in [file_id_a, file_id_b]:
+                best_similarity[file_id] = max(best_similarity.get(file_id, 0.0), similarity)
+
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["Cluster", "Path", "Similarity"])
+        for cluster_idx, cluster in enumerate(cluster_list):
+            for file_id in cluster:
+                writer.writerow([cluster_idx + 1, self.hash_index.paths[file_id], "%.4f" % best_similarity[file_id]])
@@ -5,8 +5,12 @@ import librosa
 import librosa.effects
 import soundfile as sf
 import numpy as np
+import scipy.fft
+import threading
 from typing import Optional
 
+from .profiler import profile_stage, profile_count
+
 
 class WavFingerprint(object):
 
@@ -17,15 +21,60 @@ class WavFingerprint(object):
     WINDOW_TIME = 0.02      # seconds
     MATCH_WINDOW_NUM = 3    # match window size
     FFT_WINDOW = 1024       # FFT window size
+    MATCH_CHUNK_CELLS = 1 << 22     # max compared values per chunk in match
+    MATCH_MIN_BLOCK_LEN = 64        # min offsets per bounded block in match_max
+    COARSE_ROW_STRIDE = 4           # match_coarse_max: query rows scored by the coarse stage, 1 of every stride
+    COARSE_CANDIDATES = 8           # match_coarse_max: offsets refined exactly
+    COARSE_RADIUS = 4               # match_coarse_max: offsets refined on each side of a candidate
+    PEAK_NUM = 3                    # pick_peaks: best separated offsets reported
+    PEAK_DISTANCE = 1.0             # pick_peaks: seconds between reported offsets, at least
+    FEATURE_DTYPE = np.uint8        # quantized feature: peak bin offset inside each octave
+    SPECTRUM_DTYPE = np.float32     # precision of the windows FFT
 
-    def __init__(self, samples: np.ndarray, sample_rate: int):
+    def __init__(self, samples: np.ndarray, sample_rate: int, compact: bool = False):
         # args
         self.samples: np.ndarray = samples     # 1d array
         self.sample_rate: int = sample_rate    # Hz
-        self.n_window = int(np.ceil(self.samples.shape[0] / (WavFingerprint.WINDOW_TIME * self.sample_rate)))
-        self.n_samples_per_window: int = int(WavFingerprint.WINDOW_TIME * self.sample_rate)
-        self.freq_scaling = self.n_samples_per_window / self.sample_rate
-        self.fingerprint = self._generate_fingerprint()
+        self.compact: bool = compact            # keep only the quantized feature, no samples / tiled fingerprint
+        extractor = FingerprintExtractor.get(sample_rate)
+        self.n_window: int = extractor.n_window(self.samples.shape[0])
+        self.n_samples_per_window: int = extractor.n_samples_per_window
+        self.freq_scaling: float = extractor.freq_scaling
+        self.feature: np.ndarray = extractor.extract(self.samples)     # shape=(max(n_windows, 3), octave_num)
+        self.fingerprint: Optional[np.ndarray] = None
+        if compact:
+            self.samples = None
+        else:
+            self.fingerprint = self._generate_fingerprint()
+
+    # rebuild a compact fingerprint from a stored quantized feature, without samples
+    @staticmethod
+    def from_feature(feature: np.ndarray, sample_rate: int, n_window: int) -> "WavFingerprint":
+        wav_fingerprint = WavFingerprint.__new__(WavFingerprint)
+        wav_fingerprint.samples = None
+        wav_fingerprint.sample_rate = sample_rate
+        wav_fingerprint.compact = True
+        wav_fingerprint.n_window = n_window
+        extractor = FingerprintExtractor.get(sample_rate)
+        wav_fingerprint.n_samples_per_window = extractor.n_samples_per_window
+        wav_fingerprint.freq_scaling = extractor.freq_scaling
+        wav_fingerprint.feature = feature
+        wav_fingerprint.fingerprint = None
+        return wav_fingerprint
+
+    # parameters that change the generated feature, stored fingerprints are only valid for the same values
+    @staticmethod
+    def fingerprint_params(sample_rate: int) -> dict:
+        return {
+            "FREQ_BASES": WavFingerprint.FREQ_BASES,
+            "OCTAVE_NUM": WavFingerprint.OCTAVE_NUM,
+            "OCTAVE_RATIO": WavFingerprint.OCTAVE_RATIO,
+            "WINDOW_TIME": WavFingerprint.WINDOW_TIME,
+            "MATCH_WINDOW_NUM": WavFingerprint.MATCH_WINDOW_NUM,
+            "FFT_WINDOW": WavFingerprint.FFT_WINDOW,
+            "SPECTRUM_DTYPE": np.dtype(WavFingerprint.SPECTRUM_DTYPE).name,
+            "sample_rate": sample_rate,
+        }
 
     @staticmethod
     def load_file(
@@ -33,8 +82,29 @@ class WavFingerprint(object):
         resample_rate: Optional[int] = None,
         force_to_mono: bool = False,
         selected_channels: list[int] = None,
+        compact: bool = False,
+    ) -> list["WavFingerprint"]:
+        with profile_stage("read"):
+            samples, sample_rate = sf.read(path, always_2d=True)
+        profile_count("decoded_bytes", samples.nbytes)
+        return WavFingerprint.from_samples(
+            samples, sample_rate,
+            resample_rate=resample_rate,
+            force_to_mono=force_to_mono,
+            selected_channels=selected_channels,
+            compact=compact,
+        )
+
+    # fingerprint each channel of samples, shape=(n_samples, n_channels)
+    @staticmethod
+    def from_samples(
+        samples: np.ndarray,
+        sample_rate: int,
+        resample_rate: Optional[int] = None,
+        force_to_mono: bool = False,
+        selected_channels: list[int] = None,
+        compact: bool = False,
     ) -> list["WavFingerprint"]:
-        samples, sample_rate = sf.read(path, always_2d=True)
         if force_to_mono:
             samples = samples.mean(axis=1, keepdims=True)
         if selected_channels is None:
@@ -44,12 +114,18 @@ class WavFingerprint(object):
         for chn_idx in range(samples.shape[1]):
             if chn_idx not in selected_channels:
                 continue
+            chn_sample_rate = sample_rate
             chn_samples = samples[:, chn_idx]
-            chn_samples = WavFingerprint.trim_silence(chn_samples)
+            with profile_stage("trim"):
+                chn_samples = WavFingerprint.trim_silence(chn_samples)
             if resample_rate is not None and resample_rate != sample_rate:
-                chn_samples = WavFingerprint.resample(chn_samples, sample_rate, resample_rate)
-                sample_rate = resample_rate
-            channel_fingerprints.append(WavFingerprint(samples=chn_samples, sample_rate=sample_rate))
+                with profile_stage("resample"):
+                    chn_samples = WavFingerprint.resample(chn_samples, sample_rate, resample_rate)
+                chn_sample_rate = resample_rate
+            with profile_stage("fingerprint"):
+                channel_fingerprints.append(
+                    WavFingerprint(samples=chn_samples, sample_rate=chn_sample_rate, compact=compact)
+                )
 
         return channel_fingerprints
 
@@ -61,47 +137,41 @@ class WavFingerprint(object):
     # resample to given rate on 1d array
     @staticmethod
     def resample(samples: np.ndarray, ori_sr: int, tgt_sr: int) -> np.ndarray:
-        return librosa.resample(samples, ori_sr, tgt_sr)
-
-    # generate fingerprint of given samples sequence
-    # -> shape=(n_windows - 2, octave_num, octave_num, 3)
-    def _generate_fingerprint(self) -> np.ndarray:
-
-        # pad to make sure the last window has enough samples
-        samples = self.samples
-        samples = np.pad(samples, (0, self.n_window * self.n_samples_per_window - self.samples.shape[0]))
-
-        # (n_samples,) -> (n_windows, n_samples_per_window)
-        samples = samples.reshape(self.n_window, self.n_samples_per_window)
+        return librosa.resample(samples, orig_sr=ori_sr, target_sr=tgt_sr)
 
-        # pad to FFT_WINDOW size
-        samples = np.pad(samples, ((0, 0), (0, WavFingerprint.FFT_WINDOW - self.n_samples_per_window)))
-
-        # FFT on each window
-        spectrum = np.abs(np.fft.fft(samples, axis=1))
-
-        # get feature
-        feature = []
+    # (min_freq_idx, first bin, end bin) of each octave, freq idx are scaled value
+    @staticmethod
+    def _octave_bands(freq_scaling: float) -> list[tuple[float, int, int]]:
+        bands = []
         for octave_idx in range(WavFingerprint.OCTAVE_NUM):
-            # above freqs are scaled value
             min_freq_idx = (
                 WavFingerprint.FREQ_BASES * (WavFingerprint.OCTAVE_RATIO ** octave_idx)
-            ) * self.freq_scaling
+            ) * freq_scaling
             max_freq_idx = (
                 WavFingerprint.FREQ_BASES * (WavFingerprint.OCTAVE_RATIO ** (octave_idx + 1))
-            ) * self.freq_scaling
-            strong_freq = np.argmax(        # shape=(n_windows,)
-                spectrum[:, int(min_freq_idx):int(max_freq_idx)], axis=1
-            ) + min_freq_idx
-            feature.append(np.log2(strong_freq / min_freq_idx))
-        feature = np.stack(feature, axis=1)     # shape=(n_windows, octave_num)
-
-        # n_windows should be >= WavFingerprint.MATCH_WINDOW_NUM
-        match_window_num = WavFingerprint.MATCH_WINDOW_NUM
-        if feature.shape[0] < match_window_num:
-            feature = np.pad(feature, ((0, match_window_num - feature.shape[0]), (0, 0)))
+            ) * freq_scaling
+            bands.append((min_freq_idx, int(min_freq_idx), int(max_freq_idx)))
+        return bands
+
+    # compact fingerprints of several sample sequences at one rate, windows of short ones share FFT calls
+    @staticmethod
+    def from_samples_batch(samples_list: list[np.ndarray], sample_rate: int) -> list["WavFingerprint"]:
+        extractor = FingerprintExtractor.get(sample_rate)
+        return [
+            WavFingerprint.from_feature(feature, sample_rate, extractor.n_window(samples.shape[0]))
+            for samples, feature in zip(samples_list, extractor.extract_batch(samples_list))
+        ]
+
+    # generate fingerprint from the quantized feature
+    # -> shape=(n_windows - 2, octave_num, octave_num, 3)
+    def _generate_fingerprint(self) -> np.ndarray:
+
+        # quantized feature -> log2(strong_freq / min_freq_idx)
+        min_freq_idx = FingerprintExtractor.get(self.sample_rate).min_freq_idx
+        feature = np.log2((self.feature.astype(np.int64) + min_freq_idx) / min_freq_idx)
 
         # feature to fingerprint, shape=(n_windows - 2, octave_num, octave_num, 3)
+        match_window_num = WavFingerprint.MATCH_WINDOW_NUM
         delta_t_features = [feature[:-(match_window_num - 1), :]]
         for delta_t in range(1, match_window_num):
             end_idx = - match_window_num + delta_t + 1
@@ -125,30 +195,601 @@ class WavFingerprint(object):
         if wav_a.n_window > wav_b.n_window:
             wav_a, wav_b = wav_b, wav_a
 
-        fingerprint_a = wav_a.fingerprint
-        fingerprint_b = wav_b.fingerprint
+        planes_a = wav_a.feature_planes()
+        planes_b = wav_b.feature_planes()
 
         # pad fingerprint b with len(a) // 2 before convolution
-        pad_len = fingerprint_a.shape[0] // 2
-        fingerprint_b = np.pad(
-            fingerprint_b,
-            ((pad_len, pad_len), (0, 0), (0, 0), (0, 0)),
-        )
+        pad_len = planes_a.shape[0] // 2
+        planes_b = np.pad(planes_b, ((pad_len, pad_len), (0, 0), (0, 0)))
 
-        # convolution, but calculate cos similarity instead of product
-        conv_len = fingerprint_b.shape[0] - fingerprint_a.shape[0] + 1
-        similarity_array = np.zeros((conv_len,))
-        for pos_idx in range(conv_len):
-            distance = np.linalg.norm(fingerprint_a - fingerprint_b[pos_idx:pos_idx + fingerprint_a.shape[0]], axis=3)
-            similarity_array[pos_idx] = np.sum(np.array(distance < 1e-6, dtype=np.int32))
+        return WavFingerprint._match_planes(planes_a, planes_b)
+
+    # np.max(match(wav_a, wav_b)), or None if it is not above min_score
+    # offsets are scored block by block, blocks whose score bound is not above the best score yet are skipped
+    @staticmethod
+    def match_max(wav_a: "WavFingerprint", wav_b: "WavFingerprint", min_score: float = -1.0) -> Optional[float]:
+        if wav_a.n_window > wav_b.n_window:
+            wav_a, wav_b = wav_b, wav_a
+
+        planes_a = wav_a.feature_planes()
+        planes_b = wav_b.feature_planes()
+        pad_len = planes_a.shape[0] // 2
+        planes_b = np.pad(planes_b, ((pad_len, pad_len), (0, 0), (0, 0)))
+
+        len_a = planes_a.shape[0]
+        conv_len = planes_b.shape[0] - len_a + 1
+        block_len = max(len_a, WavFingerprint.MATCH_MIN_BLOCK_LEN)
+        cell_keys_a = [
+            np.unique(keys, return_counts=True) for keys in WavFingerprint._cell_keys(planes_a)
+        ]
+        best_score = None
+        for block_start in range(0, conv_len, block_len):
+            block_end = min(block_start + block_len, conv_len)
+            planes_b_block = planes_b[block_start:block_end + len_a - 1]
+            if WavFingerprint._cell_bound(cell_keys_a, planes_b_block) <= min_score:
+                continue
+            block_score = float(np.max(WavFingerprint._match_planes(planes_a, planes_b_block)))
+            if block_score > min_score:
+                best_score = min_score = block_score
+
+        return best_score
+
+    # np.max(match(wav_a, wav_b)) in two stages, or None if it is not above min_score
+    # the coarse stage scores every offset on every row_stride-th row of a only, about 1 / row_stride of the work,
+    # then the n_candidates best separated offsets are scored exactly on all rows within radius of them
+    # the result is the exact score of the best refined offset, equal to match_max when the true peak is among them
+    @staticmethod
+    def match_coarse_max(
+        wav_a: "WavFingerprint",
+        wav_b: "WavFingerprint",
+        min_score: float = -1.0,
+        row_stride: int = COARSE_ROW_STRIDE,
+        n_candidates: int = COARSE_CANDIDATES,
+        radius: int = COARSE_RADIUS,
+    ) -> Optional[float]:
+        if wav_a.n_window > wav_b.n_window:
+            wav_a, wav_b = wav_b, wav_a
+
+        planes_a = wav_a.feature_planes()
+        planes_b = wav_b.feature_planes()
+        pad_len = planes_a.shape[0] // 2
+        planes_b = np.pad(planes_b, ((pad_len, pad_len), (0, 0), (0, 0)))
+        len_a = planes_a.shape[0]
+        conv_len = planes_b.shape[0] - len_a + 1
+
+        # coarse scores of all offsets
+        planes_coarse = planes_a[np.newaxis, ::row_stride]
+        coarse_similarity = WavFingerprint._match_planes_batch(
+            planes_coarse, np.ones(planes_coarse.shape[:2], dtype=np.int64), planes_b, row_stride
+        )[0, :conv_len]
+
+        # best offsets, neighbours of a picked offset are suppressed
+        candidates = []
+        for _ in range(min(n_candidates, conv_len)):
+            offset = int(np.argmax(coarse_similarity))
+            if coarse_similarity[offset] < 0:
+                break
+            candidates.append(offset)
+            coarse_similarity[max(offset - 2 * radius, 0):offset + 2 * radius + 1] = -1.0
+
+        # exact scores around them
+        best_score = None
+        for offset in candidates:
+            refine_start = max(offset - radius, 0)
+            refine_end = min(offset + radius + 1, conv_len)
+            refine_score = float(np.max(
+                WavFingerprint._match_planes(planes_a, planes_b[refine_start:refine_end + len_a - 1])
+            ))
+            if refine_score > min_score:
+                best_score = min_score = refine_score
+        return best_score
+
+    # n_peaks best separated offsets of match(query, key), see pick_peaks
+    @staticmethod
+    def match_peaks(
+        query: "WavFingerprint",
+        key: "WavFingerprint",
+        n_peaks: int = PEAK_NUM,
+        min_distance: float = PEAK_DISTANCE,
+    ) -> list[tuple[float, float, float, float]]:
+        return WavFingerprint.pick_peaks(WavFingerprint.match(query, key), query, key, n_peaks, min_distance)
+
+    # n_peaks best offsets of a similarity array of match(query, key), at least min_distance seconds apart
+    # -> [(offset, start, end, score)] by score, offset: time of the key where the query starts, negative if it starts
+    # before the key, [start, end]: time range of the key overlapped by the query there, all in seconds of the
+    # silence trimmed samples, offsets not above min_score are left out
+    @staticmethod
+    def pick_peaks(
+        similarity_array: np.ndarray,
+        query: "WavFingerprint",
+        key: "WavFingerprint",
+        n_peaks: int = PEAK_NUM,
+        min_distance: float = PEAK_DISTANCE,
+        min_score: float = 0.0,
+    ) -> list[tuple[float, float, float, float]]:
+        # match slides the shorter one over the longer one padded with pad_len rows before
+        swapped = query.n_window > key.n_window
+        len_a = (key if swapped else query).feature.shape[0] - WavFingerprint.MATCH_WINDOW_NUM + 1
+        pad_len = len_a // 2
+        radius = max(int(round(min_distance / WavFingerprint.WINDOW_TIME)), 1)
+        query_duration = query.n_window * WavFingerprint.WINDOW_TIME
+        key_duration = key.n_window * WavFingerprint.WINDOW_TIME
+
+        similarity_array = similarity_array.astype(np.float64)
+        peaks = []
+        for _ in range(min(n_peaks, similarity_array.shape[0])):
+            peak_idx = int(np.argmax(similarity_array))
+            score = float(similarity_array[peak_idx])
+            if score <= min_score:
+                break
+            similarity_array[max(peak_idx - radius + 1, 0):peak_idx + radius] = -np.inf
+            offset = (pad_len - peak_idx if swapped else peak_idx - pad_len) * WavFingerprint.WINDOW_TIME
+            peaks.append((offset, max(offset, 0.0), min(offset + query_duration, key_duration), score))
+        return peaks
+
+    # per octave keys of the values compared at delta_t 0 and at delta_t 1, 2
+    # -> [(n_rows, octave_num), (n_rows, octave_num)]
+    @staticmethod
+    def _cell_keys(planes: np.ndarray) -> list[np.ndarray]:
+        octave_keys = np.arange(WavFingerprint.OCTAVE_NUM, dtype=np.int64)[np.newaxis, :] << 16
+        planes = planes.astype(np.int64)
+        return [
+            octave_keys | planes[:, :, 0],
+            octave_keys | (planes[:, :, 1] << 8) | planes[:, :, 2],
+        ]
+
+    # upper bound of the score at any offset of a over b
+    # octave i at delta_t 0 matches on at most h0[i] = sum_v min(count_a[i, v], count_b[i, v]) rows, h12[j] likewise,
+    # so cell (i, j) matches on at most min(h0[i], h12[j]) rows
+    @staticmethod
+    def _cell_bound(cell_keys_a: list[tuple[np.ndarray, np.ndarray]], planes_b: np.ndarray) -> float:
+        n_matched_rows = []
+        for (keys_a, counts_a), keys_b in zip(cell_keys_a, WavFingerprint._cell_keys(planes_b)):
+            keys_b, counts_b = np.unique(keys_b, return_counts=True)
+            keys, idx_a, idx_b = np.intersect1d(keys_a, keys_b, assume_unique=True, return_indices=True)
+            n_matched_rows.append(np.bincount(
+                keys >> 16, weights=np.minimum(counts_a[idx_a], counts_b[idx_b]), minlength=WavFingerprint.OCTAVE_NUM
+            ))
+        return float(np.sum(np.minimum(n_matched_rows[0][:, np.newaxis], n_matched_rows[1][np.newaxis, :])))
+
+    # the 3 distinct planes of the fingerprint, derived from the quantized feature on the fly
+    # fingerprint[t, i, j] matches iff planes[t, i, 0], planes[t, j, 1] and planes[t, j, 2] all match
+    # -> shape=(n_windows - 2, octave_num, 3)
+    def feature_planes(self) -> np.ndarray:
+        n_rows = self.feature.shape[0] - WavFingerprint.MATCH_WINDOW_NUM + 1
+        return np.stack([
+            self.feature[delta_t:delta_t + n_rows] for delta_t in range(WavFingerprint.MATCH_WINDOW_NUM)
+        ], axis=2)
+
+    # score every offset of planes_a over (already padded) planes_b at once
+    @staticmethod
+    def _match_planes(planes_a: np.ndarray, planes_b: np.ndarray) -> np.ndarray:
+        valid = np.ones((1, planes_a.shape[0]), dtype=np.int64)
+        return WavFingerprint._match_planes_batch(planes_a[np.newaxis], valid, planes_b)[0]
+
+    # score every offset of each stacked query over (already padded) planes_b at once
+    # a cell (t, i, j) matches if all of its 3 values are equal, so the count at offset p factorizes into
+    # sum_t (n matched octaves i at delta_t 0) * (n matched octaves j at both delta_t 1 and 2)
+    # planes_q: (n_queries, len_a, octave_num, 3), valid: (n_queries, len_a) 0 for rows padded to len_a
+    # row_stride > 1 if the query rows were taken every row_stride rows, b rows are taken likewise
+    # -> shape=(n_queries, conv_len)
+    @staticmethod
+    def _match_planes_batch(
+        planes_q: np.ndarray, valid: np.ndarray, planes_b: np.ndarray, row_stride: int = 1
+    ) -> np.ndarray:
+        n_queries, len_a = planes_q.shape[:2]
+        window_len = (len_a - 1) * row_stride + 1
+        conv_len = planes_b.shape[0] - window_len + 1
+        similarity_array = np.zeros((n_queries, conv_len))
+
+        # delta_t 1 and 2 packed into one code, so a cell takes 2 compares
+        head_q, tail_q = WavFingerprint._head_tail_planes(planes_q)
+        head_b, tail_b = WavFingerprint._head_tail_planes(planes_b)
+
+        # windows over b, shape=(conv_len, len_a, octave_num), scored in chunks to bound the mask size
+        windows_head_b = np.lib.stride_tricks.sliding_window_view(head_b, window_len, axis=0)[..., ::row_stride]
+        windows_tail_b = np.lib.stride_tricks.sliding_window_view(tail_b, window_len, axis=0)[..., ::row_stride]
+        windows_head_b = windows_head_b.transpose(0, 2, 1)
+        windows_tail_b = windows_tail_b.transpose(0, 2, 1)
+        chunk_len = max(1, WavFingerprint.MATCH_CHUNK_CELLS // head_q.size)
+        for chunk_start in range(0, conv_len, chunk_len):
+            chunk_end = min(chunk_start + chunk_len, conv_len)
+            head_count = np.count_nonzero(windows_head_b[chunk_start:chunk_end, np.newaxis] == head_q, axis=3)
+            tail_count = np.count_nonzero(windows_tail_b[chunk_start:chunk_end, np.newaxis] == tail_q, axis=3)
+            similarity_array[:, chunk_start:chunk_end] = np.einsum("pqt,pqt,qt->qp", head_count, tail_count, valid)
 
         return similarity_array
 
+    # planes (..., 3) -> (delta_t 0 values, delta_t 1 and 2 values packed into uint16)
+    @staticmethod
+    def _head_tail_planes(planes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        tail = planes[..., 1].astype(np.uint16) | (planes[..., 2].astype(np.uint16) << 8)
+        return np.ascontiguousarray(planes[..., 0]), tail
+
+    # match several fingerprints (channels of a query, or several queries) against one key in one pass
+    # -> match(query, key) of each query
+    @staticmethod
+    def match_batch(queries: list["WavFingerprint"], key: "WavFingerprint") -> list[np.ndarray]:
+        similarity_arrays: list[Optional[np.ndarray]] = [None] * len(queries)
+        batch = WavFingerprint._QueryBatch(queries, key)
+        if batch.n_queries > 0:
+            batch_similarity = WavFingerprint._match_planes_batch(batch.planes_q, batch.valid, batch.planes_b)
+            for batch_idx, query_idx in enumerate(batch.query_indices):
+                start, end = batch.offset_ranges[batch_idx]
+                similarity_arrays[query_idx] = batch_similarity[batch_idx, start:end]
+        for query_idx in batch.longer_indices:
+            similarity_arrays[query_idx] = WavFingerprint.match(queries[query_idx], key)
+        return similarity_arrays
+
+    # max of match(query, key) of each query, or None if it is not above the min_score of the query
+    # offsets are scored block by block like match_max, a block is skipped if no query can beat its min_score
+    @staticmethod
+    def match_max_batch(
+        queries: list["WavFingerprint"], key: "WavFingerprint", min_scores: Optional[list[float]] = None
+    ) -> list[Optional[float]]:
+        if min_scores is None:
+            min_scores = [-1.0] * len(queries)
+        best_scores: list[Optional[float]] = [None] * len(queries)
+        batch = WavFingerprint._QueryBatch(queries, key)
+        if batch.n_queries > 0:
+            len_a = batch.planes_q.shape[1]
+            conv_len = batch.planes_b.shape[0] - len_a + 1
+            block_len = max(len_a, WavFingerprint.MATCH_MIN_BLOCK_LEN)
+            cell_keys_q = [
+                [np.unique(keys, return_counts=True) for keys in WavFingerprint._cell_keys(planes_a)]
+                for planes_a in batch.query_planes
+            ]
+            batch_min_scores = np.array([min_scores[idx] for idx in batch.query_indices], dtype=np.float64)
+            starts = np.array([start for start, _ in batch.offset_ranges])[:, np.newaxis]
+            ends = np.array([end for _, end in batch.offset_ranges])[:, np.newaxis]
+            for block_start in range(0, conv_len, block_len):
+                block_end = min(block_start + block_len, conv_len)
+                planes_b_block = batch.planes_b[block_start:block_end + len_a - 1]
+                if all([
+                    WavFingerprint._cell_bound(cell_keys_a, planes_b_block) <= batch_min_score
+                    for cell_keys_a, batch_min_score in zip(cell_keys_q, batch_min_scores)
+                ]):
+                    continue
+                block_similarity = WavFingerprint._match_planes_batch(batch.planes_q, batch.valid, planes_b_block)
+                offsets = np.arange(block_start, block_end)[np.newaxis, :]
+                block_similarity[(offsets < starts) | (offsets >= ends)] = -1.0
+                block_scores = np.max(block_similarity, axis=1)
+                for batch_idx in np.nonzero(block_scores > batch_min_scores)[0]:
+                    batch_min_scores[batch_idx] = block_scores[batch_idx]
+                    best_scores[batch.query_indices[batch_idx]] = float(block_scores[batch_idx])
+
+        for query_idx in batch.longer_indices:
+            best_scores[query_idx] = WavFingerprint.match_max(queries[query_idx], key, min_scores[query_idx])
+        return best_scores
+
+    # queries stacked for _match_planes_batch against one key
+    # the key is padded once with max(len_a) // 2 rows before and max(len_a) rows after, so the offsets of every
+    # query are a range of the shared offsets, queries longer than the key swap roles in match and are left out
+    class _QueryBatch(object):
+
+        def __init__(self, queries: list["WavFingerprint"], key: "WavFingerprint"):
+            self.query_indices = [idx for idx, query in enumerate(queries) if query.n_window <= key.n_window]
+            self.longer_indices = [idx for idx, query in enumerate(queries) if query.n_window > key.n_window]
+            self.n_queries = len(self.query_indices)
+            if self.n_queries == 0:
+                return
+
+            self.query_planes = [queries[idx].feature_planes() for idx in self.query_indices]
+            len_a = max([planes_a.shape[0] for planes_a in self.query_planes])
+            self.planes_q = np.zeros((self.n_queries, len_a) + self.query_planes[0].shape[1:], dtype=np.uint8)
+            self.valid = np.zeros((self.n_queries, len_a), dtype=np.int64)
+            for batch_idx, planes_a in enumerate(self.query_planes):
+                self.planes_q[batch_idx, :planes_a.shape[0]] = planes_a
+                self.valid[batch_idx, :planes_a.shape[0]] = 1
+
+            planes_b = key.feature_planes()
+            max_pad_len = len_a // 2
+            self.planes_b = np.pad(planes_b, ((max_pad_len, len_a), (0, 0), (0, 0)))
+
+            # offsets of match(query, key) inside the shared offsets
+            self.offset_ranges = []
+            for planes_a in self.query_planes:
+                pad_len = planes_a.shape[0] // 2
+                conv_len = planes_b.shape[0] + 2 * pad_len - planes_a.shape[0] + 1
+                start = max_pad_len - pad_len
+                self.offset_ranges.append((start, start + conv_len))
+
     @staticmethod
     def _cos_similarity(a: np.ndarray, b: np.ndarray) -> float:
         return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
 
+# Quantized feature extraction at one (sample rate, window time, FFT size)
+# octave bin tables are built once, windows are copied into a reused zero padded scratch buffer and go through
+# one FFT call per max_batch_windows windows, windows of several short signals share a call
+# scratch buffers are not shared between threads, get() keeps one extractor per thread and configuration
+class FingerprintExtractor(object):
+
+    DEFAULT_MAX_BATCH_WINDOWS = 2048    # windows per FFT call, the scratch buffer holds this many FFT windows
+
+    _thread_local = threading.local()   # .extractors: (sample rate, window time, fft window) -> extractor
+
+    def __init__(
+        self,
+        sample_rate: int,
+        window_time: float = WavFingerprint.WINDOW_TIME,
+        fft_window: int = WavFingerprint.FFT_WINDOW,
+        max_batch_windows: int = DEFAULT_MAX_BATCH_WINDOWS,
+    ):
+        self.sample_rate: int = sample_rate
+        self.window_time: float = window_time
+        self.fft_window: int = fft_window
+        self.max_batch_windows: int = max_batch_windows
+        self.n_samples_per_window: int = int(window_time * sample_rate)
+        self.freq_scaling: float = self.n_samples_per_window / sample_rate
+
+        # octaves are adjacent, the end bin of one is the first bin of the next
+        bands = WavFingerprint._octave_bands(self.freq_scaling)
+        self.min_freq_idx: np.ndarray = np.array([band[0] for band in bands])
+        self.first_bin: int = bands[0][1]
+        self.end_bin: int = bands[-1][2]
+        self.band_starts: np.ndarray = np.array([band[1] - self.first_bin for band in bands])    # start of each octave
+        self.band_widths: np.ndarray = np.array([band[2] - band[1] for band in bands])
+        self.bin_offsets: np.ndarray = (     # offset of each bin inside its octave
+            np.arange(self.end_bin - self.first_bin) - np.repeat(self.band_starts, self.band_widths)
+        )
+
+        # allocated on first use, columns past n_samples_per_window stay zero
+        self._windows: Optional[np.ndarray] = None
+        self._power: Optional[np.ndarray] = None
+
+    # shared extractor of the calling thread
+    @staticmethod
+    def get(
+        sample_rate: int, window_time: float = WavFingerprint.WINDOW_TIME, fft_window: int = WavFingerprint.FFT_WINDOW
+    ) -> "FingerprintExtractor":
+        extractors = getattr(FingerprintExtractor._thread_local, "extractors", None)
+        if extractors is None:
+            extractors = FingerprintExtractor._thread_local.extractors = {}
+        extractor = extractors.get((sample_rate, window_time, fft_window))
+        if extractor is None:
+            extractor = extractors[(sample_rate, window_time, fft_window)] = FingerprintExtractor(
+                sample_rate, window_time, fft_window
+            )
+        return extractor
+
+    # windows of n_samples samples, the last one is zero padded
+    def n_window(self, n_samples: int) -> int:
+        return int(np.ceil(n_samples / (self.window_time * self.sample_rate)))
+
+    # quantized feature of a 1d sample sequence, the strongest bin offset inside each octave
+    # -> shape=(max(n_windows, 3), octave_num)
+    def extract(self, samples: np.ndarray) -> np.ndarray:
+        return self.extract_batch([samples])[0]
+
+    # quantized features of several 1d sample sequences, rows of all of them are written into one output array
+    # -> views of shape=(max(n_windows, 3), octave_num)
+    def extract_batch(self, samples_list: list[np.ndarray]) -> list[np.ndarray]:
+        n_windows = [self.n_window(samples.shape[0]) for samples in samples_list]
+        n_rows = [max(n_window, WavFingerprint.MATCH_WINDOW_NUM) for n_window in n_windows]
+        row_starts = np.cumsum([0] + n_rows)
+        features = np.zeros((int(row_starts[-1]), WavFingerprint.OCTAVE_NUM), dtype=WavFingerprint.FEATURE_DTYPE)
+
+        # (first scratch row, first output row, n rows) of the windows in the scratch buffer
+        segments: list[tuple[int, int, int]] = []
+        n_filled = 0
+        for samples, n_window, row_start in zip(samples_list, n_windows, row_starts):
+            window_start = 0
+            while window_start < n_window:
+                window_end = min(window_start + self.max_batch_windows - n_filled, n_window)
+                self._fill_windows(samples, window_start, window_end, n_filled)
+                segments.append((n_filled, int(row_start) + window_start, window_end - window_start))
+                n_filled += window_end - window_start
+                window_start = window_end
+                if n_filled == self.max_batch_windows:
+                    self._scatter_feature(n_filled, segments, features)
+                    segments, n_filled = [], 0
+        if n_filled > 0:
+            self._scatter_feature(n_filled, segments, features)
+
+        return [features[row_start:row_end] for row_start, row_end in zip(row_starts[:-1], row_starts[1:])]
+
+    # quantized feature of each window, windows are independent
+    # (n_windows, n_samples_per_window) -> (n_windows, octave_num)
+    def window_feature(self, windows: np.ndarray) -> np.ndarray:
+        feature = np.zeros((windows.shape[0], WavFingerprint.OCTAVE_NUM), dtype=WavFingerprint.FEATURE_DTYPE)
+        self._allocate()
+        for window_start in range(0, windows.shape[0], self.max_batch_windows):
+            window_end = min(window_start + self.max_batch_windows, windows.shape[0])
+            self._windows[:window_end - window_start, :self.n_samples_per_window] = windows[window_start:window_end]
+            feature[window_start:window_end] = self._scratch_feature(window_end - window_start)
+        return feature
+
+    def _allocate(self):
+        if self._windows is None:
+            self._windows = np.zeros((self.max_batch_windows, self.fft_window), dtype=WavFingerprint.SPECTRUM_DTYPE)
+            self._power = np.zeros(
+                (self.max_batch_windows, self.end_bin - self.first_bin), dtype=WavFingerprint.SPECTRUM_DTYPE
+            )
+
+    # copy windows [window_start, window_end) of samples into the scratch buffer from scratch row n_filled
+    def _fill_windows(self, samples: np.ndarray, window_start: int, window_end: int, n_filled: int):
+        self._allocate()
+        n_samples_per_window = self.n_samples_per_window
+        scratch = self._windows[n_filled:n_filled + window_end - window_start, :n_samples_per_window]
+        segment = samples[window_start * n_samples_per_window:window_end * n_samples_per_window]
+        n_full = segment.shape[0] // n_samples_per_window
+        scratch[:n_full] = segment[:n_full * n_samples_per_window].reshape(n_full, n_samples_per_window)
+        scratch[n_full:] = 0
+        if n_full < scratch.shape[0]:
+            scratch[n_full, :segment.shape[0] - n_full * n_samples_per_window] = segment[n_full * n_samples_per_window:]
+
+    # feature of the first n_filled scratch windows written into the output rows of each segment
+    def _scatter_feature(self, n_filled: int, segments: list[tuple[int, int, int]], features: np.ndarray):
+        scratch_feature = self._scratch_feature(n_filled)
+        for scratch_start, row_start, n_rows in segments:
+            features[row_start:row_start + n_rows] = scratch_feature[scratch_start:scratch_start + n_rows]
+
+    # quantized feature of the first n_filled scratch windows -> shape=(n_filled, octave_num)
+    def _scratch_feature(self, n_filled: int) -> np.ndarray:
+
+        # real FFT on each window zero padded to fft_window, power of the octave bins only
+        spectrum = scipy.fft.rfft(self._windows[:n_filled], axis=1)[:, self.first_bin:self.end_bin]
+        power = self._power[:n_filled]
+        np.square(spectrum.real, out=power)
+        power += np.square(spectrum.imag)
+
+        # strongest bin inside each octave, first one on ties as argmax
+        band_max = np.maximum.reduceat(power, self.band_starts, axis=1)
+        is_max = power == np.repeat(band_max, self.band_widths, axis=1)
+        return np.minimum.reduceat(
+            np.where(is_max, self.bin_offsets, self.fft_window), self.band_starts, axis=1
+        ).astype(WavFingerprint.FEATURE_DTYPE)
+
+
+# Fingerprint a 1d sample stream block by block, rows are emitted as soon as their window is complete
+# the result equals WavFingerprint(samples, sample_rate).feature of the concatenated blocks
+class StreamingFingerprinter(object):
+
+    DEFAULT_BLOCK_FRAMES = 1 << 18      # frames read from file per block
+    TRIM_FRAME_LENGTH = 1024            # same as WavFingerprint.trim_silence
+    TRIM_HOP_LENGTH = 256
+    TRIM_TOP_DB = 120
+
+    def __init__(self, sample_rate: int):
+        self.sample_rate: int = sample_rate
+        self.extractor: FingerprintExtractor = FingerprintExtractor.get(sample_rate)
+        self.n_samples: int = 0         # samples pushed
+        self.n_rows: int = 0            # feature rows emitted
+        self._remainder: np.ndarray = np.zeros((0,))     # samples of the incomplete window
+
+    # push a block of samples -> feature rows of the windows completed by it, shape=(n, octave_num)
+    def push(self, samples: np.ndarray) -> np.ndarray:
+        n_samples_per_window = self.extractor.n_samples_per_window
+        self.n_samples += samples.shape[0]
+        samples = np.concatenate([self._remainder, samples])
+        n_complete = samples.shape[0] // n_samples_per_window
+        self._remainder = samples[n_complete * n_samples_per_window:]
+        windows = samples[:n_complete * n_samples_per_window].reshape(n_complete, n_samples_per_window)
+        self.n_rows += n_complete
+        return self.extractor.window_feature(windows)
+
+    # end of stream -> rows of the zero padded last window(s)
+    def flush(self) -> np.ndarray:
+        n_samples_per_window = self.extractor.n_samples_per_window
+        n_pad_rows = max(self.extractor.n_window(self.n_samples) - self.n_rows, 0)
+        samples = np.pad(self._remainder, (0, max(n_pad_rows * n_samples_per_window - self._remainder.shape[0], 0)))
+        self._remainder = np.zeros((0,))
+        self.n_rows += n_pad_rows
+        return self.extractor.window_feature(
+            samples[:n_pad_rows * n_samples_per_window].reshape(n_pad_rows, n_samples_per_window)
+        )
+
+    # compact fingerprint of all rows pushed so far
+    def to_fingerprint(self, feature_rows: list[np.ndarray]) -> WavFingerprint:
+        feature = np.concatenate(
+            feature_rows + [np.zeros((0, WavFingerprint.OCTAVE_NUM), dtype=WavFingerprint.FEATURE_DTYPE)]
+        )
+        match_window_num = WavFingerprint.MATCH_WINDOW_NUM
+        if feature.shape[0] < match_window_num:
+            feature = np.pad(feature, ((0, match_window_num - feature.shape[0]), (0, 0)))
+        return WavFingerprint.from_feature(feature, self.sample_rate, self.extractor.n_window(self.n_samples))
+
+    # same as WavFingerprint.load_file without resampling, but only one block of the file is in memory at a time
+    # the file is read twice: trim bounds of each channel first, then the fingerprint of the trimmed range
+    @staticmethod
+    def load_file(
+        path: str,
+        force_to_mono: bool = False,
+        selected_channels: list[int] = None,
+        block_frames: int = DEFAULT_BLOCK_FRAMES,
+    ) -> list[WavFingerprint]:
+        info = sf.info(path)
+        n_channels = 1 if force_to_mono else info.channels
+        if selected_channels is None:
+            selected_channels = list(range(n_channels))
+        selected_channels = [chn_idx for chn_idx in range(n_channels) if chn_idx in selected_channels]
+
+        with profile_stage("trim"):
+            trim_bounds = StreamingFingerprinter.scan_trim_bounds(path, force_to_mono, selected_channels, block_frames)
+
+        fingerprinters = [StreamingFingerprinter(info.samplerate) for _ in selected_channels]
+        feature_rows: list[list[np.ndarray]] = [[] for _ in selected_channels]
+        read_start = min([start for start, end in trim_bounds if end > start], default=0)
+        read_end = max([end for start, end in trim_bounds], default=0)
+        block_start = read_start
+        with profile_stage("fingerprint"):
+            for block in sf.blocks(path, blocksize=block_frames, start=read_start, stop=read_end, always_2d=True):
+                profile_count("decoded_bytes", block.nbytes)
+                block = StreamingFingerprinter._select_channels(block, force_to_mono, selected_channels)
+                for chn_pos, (start, end) in enumerate(trim_bounds):
+                    chn_samples = block[max(start - block_start, 0):max(end - block_start, 0), chn_pos]
+                    feature_rows[chn_pos].append(fingerprinters[chn_pos].push(chn_samples))
+                block_start += block.shape[0]
+
+        channel_fingerprints = []
+        for chn_pos, fingerprinter in enumerate(fingerprinters):
+            feature_rows[chn_pos].append(fingerprinter.flush())
+            channel_fingerprints.append(fingerprinter.to_fingerprint(feature_rows[chn_pos]))
+        return channel_fingerprints
+
+    # (start, end) sample of each channel kept by WavFingerprint.trim_silence, rms of each frame is kept in memory
+    @staticmethod
+    def scan_trim_bounds(
+        path: str,
+        force_to_mono: bool,
+        selected_channels: list[int],
+        block_frames: int = DEFAULT_BLOCK_FRAMES,
+    ) -> list[tuple[int, int]]:
+        frame_length = StreamingFingerprinter.TRIM_FRAME_LENGTH
+        hop_length = StreamingFingerprinter.TRIM_HOP_LENGTH
+
+        # centered frames with constant padding, as librosa.feature.rms
+        buffer = np.zeros((frame_length // 2, len(selected_channels)))
+        rms_blocks = []
+        n_samples = 0
+        for block in sf.blocks(path, blocksize=block_frames, always_2d=True):
+            profile_count("decoded_bytes", block.nbytes)
+            block = StreamingFingerprinter._select_channels(block, force_to_mono, selected_channels)
+            n_samples += block.shape[0]
+            buffer = np.concatenate([buffer, block])
+            n_frames = (buffer.shape[0] - frame_length) // hop_length + 1
+            if n_frames <= 0:
+                continue
+            rms_blocks.append(StreamingFingerprinter._frame_rms(buffer[:(n_frames - 1) * hop_length + frame_length]))
+            buffer = buffer[n_frames * hop_length:]
+        buffer = np.concatenate([buffer, np.zeros((frame_length // 2, len(selected_channels)))])
+        if buffer.shape[0] >= frame_length:
+            rms_blocks.append(StreamingFingerprinter._frame_rms(buffer))
+        rms = np.concatenate(rms_blocks + [np.zeros((len(selected_channels), 0))], axis=1)
+
+        trim_bounds = []
+        for chn_rms in rms:
+            db = librosa.amplitude_to_db(chn_rms, ref=np.max, top_db=None)
+            nonzero = np.flatnonzero(db > -StreamingFingerprinter.TRIM_TOP_DB)
+            if nonzero.size > 0:
+                start = int(librosa.frames_to_samples(nonzero[0], hop_length=hop_length))
+                end = min(n_samples, int(librosa.frames_to_samples(nonzero[-1] + 1, hop_length=hop_length)))
+            else:
+                start, end = 0, 0
+            trim_bounds.append((start, end))
+        return trim_bounds
+
+    # rms of every frame of buffer, (n_samples, n_channels) -> (n_channels, n_frames)
+    @staticmethod
+    def _frame_rms(buffer: np.ndarray) -> np.ndarray:
+        return np.stack([
+            librosa.feature.rms(
+                y=np.ascontiguousarray(buffer[:, chn_pos]),
+                frame_length=StreamingFingerprinter.TRIM_FRAME_LENGTH,
+                hop_length=StreamingFingerprinter.TRIM_HOP_LENGTH,
+                center=False,
+            )[0]
+            for chn_pos in range(buffer.shape[1])
+        ])
+
+    @staticmethod
+    def _select_channels(block: np.ndarray, force_to_mono: bool, selected_channels: list[int]) -> np.ndarray:
+        if force_to_mono:
+            block = block.mean(axis=1, keepdims=True)
+        return block[:, selected_channels]
+
+
 if __name__ == '__main__':
 
     # record_path = os.path.join("test_wav", "raw_SFX_UI_GiveLike.wav")
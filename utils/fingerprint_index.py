@@ -0,0 +1,339 @@
+import os
+import json
+import time
+import hashlib
+import soundfile as sf
+import numpy as np
+from typing import Optional, Iterator
+
+from .fingerprint import WavFingerprint, StreamingFingerprinter, FingerprintExtractor
+from .pcm_cache import PcmCache
+from .audio_loader import LOADER_DICT, soundfile_loader, is_supported, load_audio_channel
+from .profiler import StageProfiler, get_profiler, profile_stage
+
+
+class IndexEntry(object):
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        mtime_ns: int,
+        n_window: int,
+        feature: np.ndarray,    # (max(n_windows, 3), octave_num) quantized feature
+    ):
+        self.path: str = path
+        self.size: int = size
+        self.mtime_ns: int = mtime_ns
+        self.n_window: int = n_window
+        self.feature: np.ndarray = feature
+
+    # check file size and mtime against the stored ones
+    def is_up_to_date(self, stat: os.stat_result) -> bool:
+        return self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+
+# Difference between a directory tree and the index, and time spent on each refresh stage
+class RefreshReport(object):
+
+    def __init__(self):
+        self.added: list[str] = []
+        self.changed: list[str] = []
+        self.removed: list[str] = []
+        self.unchanged: list[str] = []
+        self.failed: dict[str, str] = {}            # path -> decode error, added or changed files left out of the index
+        self.stage_times: dict[str, float] = {}     # stage name -> seconds
+
+    # files to fingerprint
+    @property
+    def outdated(self) -> list[str]:
+        return self.added + self.changed
+
+    def summary(self) -> str:
+        return "Added: %d, Changed: %d, Removed: %d, Unchanged: %d, Failed: %d (%s)" % (
+            len(self.added), len(self.changed), len(self.removed), len(self.unchanged), len(self.failed),
+            ", ".join(["%s %.3fs" % (stage, t) for stage, t in self.stage_times.items()]),
+        )
+
+    # one warning line per failed file, empty if none failed
+    def failure_summary(self) -> str:
+        return "\n".join(["[WARNING]Skipped '%s': %s" % (path, error) for path, error in self.failed.items()])
+
+
+# Persistent fingerprints of the files under one search root, first channel only
+class FingerprintIndex(object):
+
+    INDEX_VERSION = 1
+    INDEX_EXT = ".npz"
+    DEFAULT_INDEX_DIR = os.path.abspath(os.path.join("result", "index"))     # of the command lines, as in the GUI
+    SEARCH_EXTS = list(LOADER_DICT.keys())
+    STREAMING_MIN_DURATION = 600.0      # seconds, longer files at the index rate are fingerprinted block by block
+    BATCH_MAX_WINDOWS = FingerprintExtractor.DEFAULT_MAX_BATCH_WINDOWS     # compute_entries: longer files not batched
+
+    def __init__(
+        self,
+        root: str,
+        sample_rate: int = WavFingerprint.DEFAULT_SAMPLE_RATE,
+        pcm_cache: Optional[PcmCache] = None,       # decoded samples cache used when fingerprinting files
+    ):
+        self.root: str = os.path.abspath(root)
+        self.sample_rate: int = sample_rate
+        self.pcm_cache: Optional[PcmCache] = pcm_cache
+        self.entries: dict[str, IndexEntry] = {}    # abs path -> entry
+        self.modified: bool = False                 # entries changed since load / save
+
+    # index file for root inside index_dir
+    @staticmethod
+    def default_index_path(root: str, index_dir: str) -> str:
+        root = os.path.abspath(root)
+        root_hash = hashlib.sha1(root.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(index_dir, "%s_%s%s" % (os.path.basename(root), root_hash, FingerprintIndex.INDEX_EXT))
+
+    # list audio and video files of every supported ext under root recursively
+    @staticmethod
+    def scan_files(root: str) -> list[str]:
+        paths = []
+        for dir_path, _, file_names in os.walk(os.path.abspath(root)):
+            paths += [os.path.join(dir_path, file_name) for file_name in sorted(file_names) if is_supported(file_name)]
+        return paths
+
+    # parameters stored along with the index
+    def index_params(self) -> dict:
+        params = WavFingerprint.fingerprint_params(self.sample_rate)
+        params["INDEX_VERSION"] = FingerprintIndex.INDEX_VERSION
+        params["root"] = self.root
+        return params
+
+    # load entries from index_path, entries are dropped if the index is missing or built with other params
+    def load(self, index_path: str) -> bool:
+        self.entries = {}
+        self.modified = False
+        if not os.path.isfile(index_path):
+            return False
+
+        with np.load(index_path, allow_pickle=False) as data:
+            if json.loads(str(data["params"])) != self.index_params():
+                return False
+            paths = data["paths"]
+            sizes = data["sizes"]
+            mtimes_ns = data["mtimes_ns"]
+            n_windows = data["n_windows"]
+            offsets = data["offsets"]
+            features = data["features"]
+
+        for entry_idx, path in enumerate(paths):
+            path = str(path)
+            self.entries[path] = IndexEntry(
+                path=path,
+                size=int(sizes[entry_idx]),
+                mtime_ns=int(mtimes_ns[entry_idx]),
+                n_window=int(n_windows[entry_idx]),
+                feature=features[offsets[entry_idx]:offsets[entry_idx + 1]],
+            )
+        return True
+
+    # save all entries to index_path, features are concatenated into one matrix
+    def save(self, index_path: str):
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+        entries = list(self.entries.values())
+        offsets = np.zeros((len(entries) + 1,), dtype=np.int64)
+        offsets[1:] = np.cumsum([entry.feature.shape[0] for entry in entries], dtype=np.int64)
+        if len(entries) > 0:
+            features = np.concatenate([entry.feature for entry in entries], axis=0)
+        else:
+            features = np.zeros((0, WavFingerprint.OCTAVE_NUM), dtype=WavFingerprint.FEATURE_DTYPE)
+
+        # write to a temp file first, so an interrupted save keeps the previous index
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                params=np.array(json.dumps(self.index_params())),
+                paths=np.array([entry.path for entry in entries], dtype=str),
+                sizes=np.array([entry.size for entry in entries], dtype=np.int64),
+                mtimes_ns=np.array([entry.mtime_ns for entry in entries], dtype=np.int64),
+                n_windows=np.array([entry.n_window for entry in entries], dtype=np.int64),
+                offsets=offsets,
+                features=features,
+            )
+        os.replace(tmp_path, index_path)
+        self.modified = False
+
+    # store a computed entry into the index
+    def put(self, entry: IndexEntry):
+        self.entries[entry.path] = entry
+        self.modified = True
+
+    # decode paths and compute their index entries, file stats are taken before decoding
+    # trimmed samples of short files are fingerprinted together, their windows share FFT calls, see
+    # FingerprintExtractor.extract_batch, files of BATCH_MAX_WINDOWS windows or more are fingerprinted one by one,
+    # so only short samples are held until the batch
+    # -> (entry, None) of each path, or (None, decode error) for files that cannot be decoded, e.g. videos without audio
+    @staticmethod
+    def compute_entries(
+        paths: list[str], sample_rate: int, pcm_cache: Optional[PcmCache] = None
+    ) -> list[tuple[Optional[IndexEntry], Optional[str]]]:
+        profiler = get_profiler()
+        extractor = FingerprintExtractor.get(sample_rate)
+        batch_max_samples = FingerprintIndex.BATCH_MAX_WINDOWS * extractor.n_samples_per_window
+        results: list[tuple[Optional[IndexEntry], Optional[str]]] = [(None, None)] * len(paths)
+        batch: list[tuple[int, str, os.stat_result, np.ndarray]] = []    # (path idx, path, stat, samples)
+        for path_idx, path in enumerate(paths):
+            path = os.path.abspath(path)
+            if profiler is not None:
+                profiler.begin_file(path)
+            try:
+                stat = os.stat(path)
+                samples, fingerprint = FingerprintIndex._load_samples(path, sample_rate, pcm_cache)
+                if fingerprint is None and samples.shape[0] >= batch_max_samples:
+                    with profile_stage("fingerprint"):
+                        fingerprint = WavFingerprint(np.asarray(samples, dtype=np.float64), sample_rate, compact=True)
+            except (RuntimeError, OSError) as e:
+                results[path_idx] = (None, (str(e).strip().splitlines() or [type(e).__name__])[0])
+                continue
+            finally:
+                if profiler is not None:
+                    profiler.end_file()
+            if fingerprint is None:
+                batch.append((path_idx, path, stat, samples))
+            else:
+                results[path_idx] = (FingerprintIndex._entry(path, stat, fingerprint), None)
+
+        # batch fingerprint time is split over its files by their length
+        start_time = time.perf_counter()
+        fingerprints = WavFingerprint.from_samples_batch([samples for _, _, _, samples in batch], sample_rate)
+        batch_time = time.perf_counter() - start_time
+        n_batch_samples = max(sum([samples.shape[0] for _, _, _, samples in batch]), 1)
+        for (path_idx, path, stat, samples), fingerprint in zip(batch, fingerprints):
+            results[path_idx] = (FingerprintIndex._entry(path, stat, fingerprint), None)
+            if profiler is not None:
+                profiler.begin_file(path)
+                profiler.add_time("fingerprint", batch_time * samples.shape[0] / n_batch_samples)
+                profiler.end_file()
+        return results
+
+    # trimmed samples of path at sample_rate -> (samples, None), or (None, fingerprint) for long files at the index
+    # rate, which are fingerprinted block by block
+    @staticmethod
+    def _load_samples(
+        path: str, sample_rate: int, pcm_cache: Optional[PcmCache] = None
+    ) -> tuple[Optional[np.ndarray], Optional[WavFingerprint]]:
+        is_soundfile = LOADER_DICT[os.path.splitext(path)[1].lower()] is soundfile_loader
+        info = sf.info(path) if is_soundfile else None
+        if (
+            info is not None and info.samplerate == sample_rate
+            and info.duration >= FingerprintIndex.STREAMING_MIN_DURATION
+        ):
+            return None, StreamingFingerprinter.load_file(path=path, selected_channels=[0])[0]
+        if pcm_cache is not None:
+            return pcm_cache.load_samples(path, sample_rate, channel=0), None
+
+        with profile_stage("read"):
+            samples, ori_sample_rate = load_audio_channel(path, channel=0)
+        with profile_stage("trim"):
+            samples = WavFingerprint.trim_silence(samples)
+        if ori_sample_rate != sample_rate:
+            with profile_stage("resample"):
+                samples = WavFingerprint.resample(samples, ori_sample_rate, sample_rate)
+        return samples, None
+
+    @staticmethod
+    def _entry(path: str, stat: os.stat_result, fingerprint: WavFingerprint) -> IndexEntry:
+        return IndexEntry(
+            path=path,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            n_window=fingerprint.n_window,
+            feature=fingerprint.feature,
+        )
+
+    # drop entries of given paths
+    def remove(self, paths: list[str]):
+        for path in paths:
+            if self.entries.pop(os.path.abspath(path), None) is not None:
+                self.modified = True
+
+    # compare files of paths with the index, paths are scanned from root if not given, report is filled if given
+    def diff(self, paths: Optional[list[str]] = None, report: Optional[RefreshReport] = None) -> RefreshReport:
+        if report is None:
+            report = RefreshReport()
+        if paths is None:
+            start_time = time.perf_counter()
+            paths = FingerprintIndex.scan_files(self.root)
+            report.stage_times["scan"] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        current_paths = set()
+        for path in paths:
+            path = os.path.abspath(path)
+            current_paths.add(path)
+            entry = self.entries.get(path)
+            if entry is None:
+                report.added.append(path)
+            elif entry.is_up_to_date(os.stat(path)):
+                report.unchanged.append(path)
+            else:
+                report.changed.append(path)
+        report.removed = [path for path in self.entries.keys() if path not in current_paths]
+        report.stage_times["diff"] = time.perf_counter() - start_time
+
+        return report
+
+    # bring the index up to date with the tree, only added or changed files are fingerprinted on a process pool
+    def refresh(
+        self,
+        paths: Optional[list[str]] = None,
+        n_workers: Optional[int] = None,            # None for all cpus, 1 to run in the calling process
+        profiler: Optional[StageProfiler] = None,   # stage timings of every fingerprinted file are merged into it
+    ) -> RefreshReport:
+        report = RefreshReport()
+        for _ in self.iter_refresh(report, paths, n_workers, profiler):
+            pass
+        return report
+
+    # load the stored index of root from index_dir unless entries are loaded already, refresh it and save it
+    # if it changed, index_dir None keeps it in memory only
+    def sync(
+        self,
+        index_dir: Optional[str] = DEFAULT_INDEX_DIR,
+        paths: Optional[list[str]] = None,
+        n_workers: Optional[int] = None,
+        profiler: Optional[StageProfiler] = None,
+    ) -> RefreshReport:
+        index_path = None
+        if index_dir is not None:
+            index_path = FingerprintIndex.default_index_path(self.root, index_dir)
+            if len(self.entries) == 0:
+                self.load(index_path)
+        report = self.refresh(paths, n_workers, profiler)
+        if index_path is not None and self.modified:
+            self.save(index_path)
+        return report
+
+    # refresh step by step, yield every fingerprinted path, so a caller can stop in between
+    # report is filled in place, its fingerprint stage time covers the steps run so far
+    # files failing to decode are kept out of the index and listed in report.failed, they are tried again next time
+    def iter_refresh(
+        self,
+        report: RefreshReport,
+        paths: Optional[list[str]] = None,
+        n_workers: Optional[int] = None,
+        profiler: Optional[StageProfiler] = None,
+    ) -> Iterator[str]:
+        from .search_engine import SearchEngine     # imports this module
+
+        self.diff(paths, report)
+        self.remove(report.removed)
+
+        start_time = time.perf_counter()
+        try:
+            for path, error in SearchEngine.index_files(self, report.outdated, n_workers, self.pcm_cache, profiler):
+                if error is not None:
+                    report.failed[path] = error
+                    self.remove([path])     # stale entry of a changed file
+                yield path
+        finally:
+            report.stage_times["fingerprint"] = time.perf_counter() - start_time
@@ -0,0 +1,261 @@
+import os
+import json
+import shutil
+import numpy as np
+from typing import Optional
+
+from .fingerprint import WavFingerprint
+from .fingerprint_index import IndexEntry
+
+
+# Append-only sharded fingerprint store for libraries larger than memory, first channel only
+# each shard is 3 files appended in order: raw feature rows, a fixed width record table and one path per line
+# shards are opened with np.memmap, so processes reading the same store share the os page cache
+# a later record of a path replaces the earlier ones, a record with n_window < 0 removes the path
+# one process appends at a time, any number of processes read
+class FingerprintStore(object):
+
+    STORE_VERSION = 1
+    PARAMS_FILE = "store.json"
+    SHARD_FORMAT = "shard_%05d"
+    FEATURES_EXT = ".features"
+    TABLE_EXT = ".table"
+    PATHS_EXT = ".paths"
+    SHARD_MAX_ROWS = 1 << 24        # feature rows per shard, 192MB at 12 octaves
+    FLUSH_ENTRIES = 256             # entries buffered by put before they are appended
+    COMPACT_DEAD_RATIO = 0.5        # replaced and removed records of all records before the store needs compaction
+    COMPACT_MIN_RECORDS = 4096      # dead records before the store needs compaction
+    TABLE_DTYPE = np.dtype([
+        ("row", "<i8"),         # first feature row inside the shard
+        ("n_rows", "<i8"),
+        ("n_window", "<i8"),
+        ("size", "<i8"),
+        ("mtime_ns", "<i8"),
+    ])
+
+    def __init__(self, store_dir: str, sample_rate: int = WavFingerprint.DEFAULT_SAMPLE_RATE):
+        self.store_dir: str = os.path.abspath(store_dir)
+        self.sample_rate: int = sample_rate
+        self.shard_features: list[np.ndarray] = []      # memmap of each shard, shape=(n_rows, octave_num)
+        self.shard_tables: list[np.ndarray] = []        # memmap of each shard, dtype=TABLE_DTYPE
+        self.locations: dict[str, tuple[int, int]] = {}     # abs path -> (shard idx, record idx) of latest record
+        self.pending: list[IndexEntry] = []             # entries put but not appended yet
+        self._shard_records: list[int] = []     # complete records of each shard
+        self._shard_path_bytes: list[int] = []  # bytes of the paths of complete records of each shard
+
+    def store_params(self) -> dict:
+        params = WavFingerprint.fingerprint_params(self.sample_rate)
+        params["STORE_VERSION"] = FingerprintStore.STORE_VERSION
+        return params
+
+    def shard_path(self, shard_idx: int, ext: str) -> str:
+        return os.path.join(self.store_dir, FingerprintStore.SHARD_FORMAT % shard_idx + ext)
+
+    def _reset(self):
+        self.shard_features = []
+        self.shard_tables = []
+        self.locations = {}
+        self._shard_records = []
+        self._shard_path_bytes = []
+
+    # map all shards, False if the store is missing or built with other params
+    def open(self) -> bool:
+        self._reset()
+        params_path = os.path.join(self.store_dir, FingerprintStore.PARAMS_FILE)
+        if not os.path.isfile(params_path):
+            return False
+        with open(params_path, "r") as f:
+            if json.load(f) != self.store_params():
+                return False
+
+        shard_idx = 0
+        while os.path.isfile(self.shard_path(shard_idx, FingerprintStore.PATHS_EXT)):
+            self._map_shard(shard_idx)
+            shard_idx += 1
+        return True
+
+    # (re)map shard files and read the paths appended since the last call
+    # records of an interrupted append, missing their path or feature rows, are ignored
+    def _map_shard(self, shard_idx: int):
+        if shard_idx == len(self.shard_features):
+            self.shard_features.append(None)
+            self.shard_tables.append(None)
+            self._shard_records.append(0)
+            self._shard_path_bytes.append(0)
+        table = FingerprintStore._memmap(
+            self.shard_path(shard_idx, FingerprintStore.TABLE_EXT), FingerprintStore.TABLE_DTYPE, ()
+        )
+        features = FingerprintStore._memmap(
+            self.shard_path(shard_idx, FingerprintStore.FEATURES_EXT),
+            WavFingerprint.FEATURE_DTYPE,
+            (WavFingerprint.OCTAVE_NUM,),
+        )
+        self.shard_features[shard_idx] = features
+        self.shard_tables[shard_idx] = table
+
+        with open(self.shard_path(shard_idx, FingerprintStore.PATHS_EXT), "rb") as f:
+            f.seek(self._shard_path_bytes[shard_idx])
+            new_paths = f.read().split(b"\n")[:-1]
+        record_idx = self._shard_records[shard_idx]
+        for path_bytes in new_paths:
+            if record_idx >= table.shape[0]:
+                break
+            record = table[record_idx]
+            if record["row"] + record["n_rows"] > features.shape[0]:
+                break
+            path = path_bytes.decode("utf-8")
+            if record["n_window"] < 0:
+                self.locations.pop(path, None)
+            else:
+                self.locations[path] = (shard_idx, record_idx)
+            record_idx += 1
+            self._shard_path_bytes[shard_idx] += len(path_bytes) + 1
+        self._shard_records[shard_idx] = record_idx
+
+    # read only memmap of a raw file of fixed width items, empty array for an empty file
+    @staticmethod
+    def _memmap(path: str, dtype, item_shape: tuple) -> np.ndarray:
+        item_bytes = np.dtype(dtype).itemsize * int(np.prod(item_shape, dtype=np.int64))
+        n_items = os.path.getsize(path) // item_bytes if os.path.isfile(path) else 0
+        if n_items == 0:
+            return np.zeros((0,) + item_shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(n_items,) + item_shape)
+
+    # entry of a record, the feature is a view of the shard memmap
+    def entry_at(self, shard_idx: int, record_idx: int, path: str = "") -> IndexEntry:
+        record = self.shard_tables[shard_idx][record_idx]
+        row = int(record["row"])
+        return IndexEntry(
+            path=path,
+            size=int(record["size"]),
+            mtime_ns=int(record["mtime_ns"]),
+            n_window=int(record["n_window"]),
+            feature=self.shard_features[shard_idx][row:row + int(record["n_rows"])],
+        )
+
+    # (shard idx, record idx) of path if it is stored and its file did not change since
+    def locate(self, path: str, stat: os.stat_result) -> Optional[tuple[int, int]]:
+        location = self.locations.get(os.path.abspath(path))
+        if location is None:
+            return None
+        record = self.shard_tables[location[0]][location[1]]
+        if record["size"] != stat.st_size or record["mtime_ns"] != stat.st_mtime_ns:
+            return None
+        return location
+
+    # store a computed entry, appended with the next flush
+    def put(self, entry: IndexEntry):
+        self.pending.append(entry)
+        if len(self.pending) >= FingerprintStore.FLUSH_ENTRIES:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        self.append(pending)
+
+    # append removal records of stored paths
+    def remove(self, paths: list[str]):
+        self.flush()
+        self.append([
+            IndexEntry(path=path, size=0, mtime_ns=0, n_window=-1, feature=np.zeros((0, WavFingerprint.OCTAVE_NUM)))
+            for path in [os.path.abspath(path) for path in paths] if path in self.locations
+        ])
+
+    # append entries to the last shard, a new shard is started when an entry would not fit in it
+    # an entry longer than SHARD_MAX_ROWS gets a shard of its own
+    # a store built with other params is cleared first
+    def append(self, entries: list[IndexEntry]):
+        params_path = os.path.join(self.store_dir, FingerprintStore.PARAMS_FILE)
+        if not os.path.isfile(params_path) or len(self.shard_features) == 0 and not self.open():
+            self.clear()
+            os.makedirs(self.store_dir, exist_ok=True)
+            with open(params_path, "w") as f:
+                json.dump(self.store_params(), f, indent=2)
+
+        entry_rows = [entry.feature.shape[0] if entry.n_window >= 0 else 0 for entry in entries]
+        entry_start = 0
+        while entry_start < len(entries):
+            shard_idx = max(len(self.shard_features) - 1, 0)
+            shard_rows = 0
+            if shard_idx < len(self.shard_tables) and self._shard_records[shard_idx] > 0:
+                last_record = self.shard_tables[shard_idx][self._shard_records[shard_idx] - 1]
+                shard_rows = int(last_record["row"] + last_record["n_rows"])
+            if shard_rows > 0 and shard_rows + entry_rows[entry_start] > FingerprintStore.SHARD_MAX_ROWS:
+                shard_idx += 1
+                shard_rows = 0
+
+            entry_end = entry_start + 1
+            end_rows = shard_rows + entry_rows[entry_start]
+            while entry_end < len(entries) and end_rows + entry_rows[entry_end] <= FingerprintStore.SHARD_MAX_ROWS:
+                end_rows += entry_rows[entry_end]
+                entry_end += 1
+            self._append_shard(shard_idx, shard_rows, entries[entry_start:entry_end])
+            entry_start = entry_end
+
+    # append entries fitting in a shard after its first shard_rows feature rows
+    def _append_shard(self, shard_idx: int, shard_rows: int, entries: list[IndexEntry]):
+        # cut the tail of an interrupted append, then write features, table and paths in that order
+        n_records = self._shard_records[shard_idx] if shard_idx < len(self._shard_records) else 0
+        path_bytes = self._shard_path_bytes[shard_idx] if shard_idx < len(self._shard_path_bytes) else 0
+        feature_row_bytes = WavFingerprint.OCTAVE_NUM * np.dtype(WavFingerprint.FEATURE_DTYPE).itemsize
+        for ext, n_bytes in [
+            (FingerprintStore.FEATURES_EXT, shard_rows * feature_row_bytes),
+            (FingerprintStore.TABLE_EXT, n_records * FingerprintStore.TABLE_DTYPE.itemsize),
+            (FingerprintStore.PATHS_EXT, path_bytes),
+        ]:
+            file_path = self.shard_path(shard_idx, ext)
+            if os.path.isfile(file_path) and os.path.getsize(file_path) > n_bytes:
+                os.truncate(file_path, n_bytes)
+
+        table = np.zeros((len(entries),), dtype=FingerprintStore.TABLE_DTYPE)
+        with open(self.shard_path(shard_idx, FingerprintStore.FEATURES_EXT), "ab") as f:
+            for entry_idx, entry in enumerate(entries):
+                n_rows = entry.feature.shape[0] if entry.n_window >= 0 else 0
+                table[entry_idx] = (shard_rows, n_rows, entry.n_window, entry.size, entry.mtime_ns)
+                if n_rows > 0:
+                    f.write(np.ascontiguousarray(entry.feature, dtype=WavFingerprint.FEATURE_DTYPE).data)
+                shard_rows += n_rows
+        with open(self.shard_path(shard_idx, FingerprintStore.TABLE_EXT), "ab") as f:
+            f.write(table.data)
+        with open(self.shard_path(shard_idx, FingerprintStore.PATHS_EXT), "ab") as f:
+            f.write(b"".join([os.path.abspath(entry.path).encode("utf-8") + b"\n" for entry in entries]))
+        self._map_shard(shard_idx)
+
+    # delete all shards
+    def clear(self):
+        self._reset()
+        if not os.path.isdir(self.store_dir):
+            return
+        shard_exts = (FingerprintStore.FEATURES_EXT, FingerprintStore.TABLE_EXT, FingerprintStore.PATHS_EXT)
+        for file_name in os.listdir(self.store_dir):
+            if file_name.endswith(shard_exts):
+                os.remove(os.path.join(self.store_dir, file_name))
+
+    # records replaced by a later record of their path or removing it
+    def n_dead_records(self) -> int:
+        return sum(self._shard_records) - len(self.locations)
+
+    # True if enough records are dead for compact to be worth a rewrite of the store
+    def needs_compact(self) -> bool:
+        n_dead = self.n_dead_records()
+        return (
+            n_dead >= FingerprintStore.COMPACT_MIN_RECORDS
+            and n_dead > FingerprintStore.COMPACT_DEAD_RATIO * sum(self._shard_records)
+        )
+
+    # rewrite the store with only the latest record of each path, replaced and removed records are dropped
+    # records are copied shard by shard into a new store, which then replaces this one
+    def compact(self):
+        self.flush()
+        compact_store = FingerprintStore(self.store_dir + ".compact", self.sample_rate)
+        compact_store.clear()
+        locations = sorted([(location, path) for path, location in self.locations.items()])
+        for location, path in locations:
+            compact_store.put(self.entry_at(location[0], location[1], path))
+        compact_store.flush()
+
+        self.clear()
+        for file_name in os.listdir(compact_store.store_dir):
+            os.replace(os.path.join(compact_store.store_dir, file_name), os.path.join(self.store_dir, file_name))
+        shutil.rmtree(compact_store.store_dir, ignore_errors=True)
+        self.open()
@@ -0,0 +1,235 @@
+import os
+import json
+import hashlib
+import numpy as np
+from typing import Optional
+
+from .fingerprint import WavFingerprint
+from .fingerprint_index import FingerprintIndex
+from .search_engine import SearchEngine
+
+
+# Inverted index from quantized fingerprint triplets to (file, time offset) postings
+# each fingerprint row gives one hash per octave i: (i, feature[t, i], feature[t + 1, i], feature[t + 2, i])
+class HashIndex(object):
+
+    INDEX_VERSION = 2
+    INDEX_EXT = ".hash.npz"
+    VALUE_BITS = 8                  # bits of one quantized feature value
+    MAX_FILE_RATIO = 0.1            # hashes of more than this share of the files carry no information, not indexed
+    MIN_MAX_FILES = 100             # but only if they are in more files than this, small libraries keep every hash
+    DEFAULT_MAX_QUERY_HITS = 1 << 22    # postings expanded per vote, the most common query hashes are skipped beyond
+
+    def __init__(self, sample_rate: int = WavFingerprint.DEFAULT_SAMPLE_RATE):
+        self.sample_rate: int = sample_rate
+        self.max_query_hits: int = HashIndex.DEFAULT_MAX_QUERY_HITS
+        self.entries_key: str = ""      # of the fingerprint index entries it is built from, see entries_key
+
+        # files
+        self.paths: list[str] = []
+        self.n_windows: np.ndarray = np.zeros((0,), dtype=np.int64)
+        self.feature_offsets: np.ndarray = np.zeros((1,), dtype=np.int64)
+        self.features: np.ndarray = np.zeros((0, WavFingerprint.OCTAVE_NUM), dtype=WavFingerprint.FEATURE_DTYPE)
+
+        # postings sorted by hash
+        self.hashes: np.ndarray = np.zeros((0,), dtype=np.int64)
+        self.file_ids: np.ndarray = np.zeros((0,), dtype=np.int32)
+        self.times: np.ndarray = np.zeros((0,), dtype=np.int32)
+
+    # hash of every (row, octave) of a fingerprint
+    # -> shape=(n_windows - 2, octave_num)
+    @staticmethod
+    def fingerprint_hashes(fingerprint: WavFingerprint) -> np.ndarray:
+        planes = fingerprint.feature_planes().astype(np.int64)
+        hashes = np.arange(WavFingerprint.OCTAVE_NUM, dtype=np.int64)[np.newaxis, :]
+        for delta_t in range(WavFingerprint.MATCH_WINDOW_NUM):
+            hashes = (hashes << HashIndex.VALUE_BITS) | planes[:, :, delta_t]
+        return hashes
+
+    # hash index file of root inside index_dir, next to its fingerprint index
+    @staticmethod
+    def default_index_path(root: str, index_dir: str) -> str:
+        return os.path.splitext(FingerprintIndex.default_index_path(root, index_dir))[0] + HashIndex.INDEX_EXT
+
+    # digest of the paths, sizes and mtimes of the entries of a fingerprint index
+    @staticmethod
+    def entries_key(index: FingerprintIndex) -> str:
+        digest = hashlib.sha1()
+        for path in sorted(index.entries.keys()):
+            entry = index.entries[path]
+            digest.update(("%s\0%d\0%d\n" % (path, entry.size, entry.mtime_ns)).encode("utf-8"))
+        return digest.hexdigest()
+
+    # hash index of the entries of index, current is kept if it is built from the same entries, else the one stored
+    # in index_dir is loaded if it is, else it is built and stored there, index_dir None keeps it in memory only
+    @staticmethod
+    def sync(
+        index: FingerprintIndex,
+        index_dir: Optional[str] = FingerprintIndex.DEFAULT_INDEX_DIR,
+        current: Optional["HashIndex"] = None,
+    ) -> "HashIndex":
+        entries_key = HashIndex.entries_key(index)
+        if current is not None and current.sample_rate == index.sample_rate and current.entries_key == entries_key:
+            return current
+        index_path = None
+        if index_dir is not None:
+            index_path = HashIndex.default_index_path(index.root, index_dir)
+            hash_index = HashIndex.load(index_path, index.sample_rate, entries_key)
+            if hash_index is not None:
+                return hash_index
+        hash_index = HashIndex.from_fingerprint_index(index, entries_key)
+        if index_path is not None:
+            hash_index.save(index_path)
+        return hash_index
+
+    # build from all entries of a fingerprint index
+    @staticmethod
+    def from_fingerprint_index(index: FingerprintIndex, entries_key: Optional[str] = None) -> "HashIndex":
+        hash_index = HashIndex(sample_rate=index.sample_rate)
+        hash_index.entries_key = HashIndex.entries_key(index) if entries_key is None else entries_key
+        entries = list(index.entries.values())
+        hash_index.paths = [entry.path for entry in entries]
+        hash_index.n_windows = np.array([entry.n_window for entry in entries], dtype=np.int64)
+        hash_index.feature_offsets = np.zeros((len(entries) + 1,), dtype=np.int64)
+        hash_index.feature_offsets[1:] = np.cumsum([entry.feature.shape[0] for entry in entries], dtype=np.int64)
+        if len(entries) > 0:
+            hash_index.features = np.concatenate([entry.feature for entry in entries], axis=0)
+        hash_index._build_postings()
+        return hash_index
+
+    # fingerprint of file_id
+    def fingerprint(self, file_id: int) -> WavFingerprint:
+        feature = self.features[self.feature_offsets[file_id]:self.feature_offsets[file_id + 1]]
+        return WavFingerprint.from_feature(feature, self.sample_rate, int(self.n_windows[file_id]))
+
+    # postings of all files at once, the hash rows of a file are the rows of its feature but the last 2,
+    # same as fingerprint_hashes of each file, hashes of too many files are left out, see MAX_FILE_RATIO
+    def _build_postings(self):
+        if len(self.paths) == 0:
+            return
+        n_hash_rows = np.diff(self.feature_offsets) - WavFingerprint.MATCH_WINDOW_NUM + 1
+        row_file_ids = np.repeat(np.arange(len(self.paths), dtype=np.int32), n_hash_rows)
+        row_starts = np.repeat(np.cumsum(n_hash_rows) - n_hash_rows, n_hash_rows)
+        row_times = np.arange(row_file_ids.shape[0], dtype=np.int64) - row_starts
+        row_idx = self.feature_offsets[row_file_ids] + row_times
+
+        hashes = np.arange(WavFingerprint.OCTAVE_NUM, dtype=np.int64)[np.newaxis, :]
+        for delta_t in range(WavFingerprint.MATCH_WINDOW_NUM):
+            hashes = (hashes << HashIndex.VALUE_BITS) | self.features[row_idx + delta_t].astype(np.int64)
+        hashes = hashes.reshape(-1)
+        order = np.argsort(hashes, kind="stable")
+        hashes = hashes[order]
+        file_ids = np.repeat(row_file_ids, WavFingerprint.OCTAVE_NUM)[order]
+        times = np.repeat(row_times.astype(np.int32), WavFingerprint.OCTAVE_NUM)[order]
+
+        # files of each hash, postings of a hash stay in file order
+        hash_starts = np.r_[True, hashes[1:] != hashes[:-1]]
+        file_starts = hash_starts | np.r_[True, file_ids[1:] != file_ids[:-1]]
+        hash_ids = np.cumsum(hash_starts) - 1
+        n_hash_files = np.bincount(hash_ids, weights=file_starts)
+        max_files = max(HashIndex.MIN_MAX_FILES, int(HashIndex.MAX_FILE_RATIO * len(self.paths)))
+        kept = n_hash_files[hash_ids] <= max_files
+        self.hashes = hashes[kept]
+        self.file_ids = file_ids[kept]
+        self.times = times[kept]
+
+    # offset-consistent votes of one query fingerprint
+    # -> {file_id: max number of hashes agreeing on one time offset}
+    def vote(self, query_fingerprint: WavFingerprint) -> dict[int, int]:
+        query_hashes = HashIndex.fingerprint_hashes(query_fingerprint)
+        query_times = np.repeat(np.arange(query_hashes.shape[0], dtype=np.int64), query_hashes.shape[1])
+        query_hashes = query_hashes.reshape(-1)
+
+        # posting range of each query hash
+        posting_starts = np.searchsorted(self.hashes, query_hashes, side="left")
+        posting_counts = np.searchsorted(self.hashes, query_hashes, side="right") - posting_starts
+        n_hits = int(np.sum(posting_counts))
+        if n_hits > self.max_query_hits:
+            order = np.argsort(posting_counts, kind="stable")
+            posting_counts[order[np.cumsum(posting_counts[order]) > self.max_query_hits]] = 0
+            n_hits = int(np.sum(posting_counts))
+        if n_hits == 0:
+            return {}
+
+        # expand ranges into hit indices
+        hit_starts = np.repeat(posting_starts - np.cumsum(posting_counts) + posting_counts, posting_counts)
+        hit_idx = hit_starts + np.arange(n_hits)
+        hit_files = self.file_ids[hit_idx].astype(np.int64)
+        hit_offsets = self.times[hit_idx].astype(np.int64) - np.repeat(query_times, posting_counts)
+
+        # count hits per (file, offset), keep the best offset of each file
+        vote_keys, vote_counts = np.unique((hit_files << 32) | (hit_offsets & 0xFFFFFFFF), return_counts=True)
+        vote_files = vote_keys >> 32
+        file_starts = np.flatnonzero(np.r_[True, vote_files[1:] != vote_files[:-1]])
+        file_votes = np.maximum.reduceat(vote_counts, file_starts)
+        return dict(zip(vote_files[file_starts].tolist(), file_votes.tolist()))
+
+    # top_k files by votes of all query channels -> [(file_id, votes)]
+    def candidates(self, query_fingerprints: list[WavFingerprint], top_k: int) -> list[tuple[int, int]]:
+        file_votes: dict[int, int] = {}
+        for q_chn_fingerprint in query_fingerprints:
+            for file_id, votes in self.vote(q_chn_fingerprint).items():
+                file_votes[file_id] = max(file_votes.get(file_id, 0), votes)
+        candidate_list = sorted(file_votes.items(), key=lambda c: c[1], reverse=True)
+        return candidate_list[:top_k]
+
+    # exact match on the top_k candidates -> [(path, score)] sorted by score
+    def search(self, query_fingerprints: list[WavFingerprint], top_k: int) -> list[tuple[str, float]]:
+        result_list = [
+            (self.paths[file_id], SearchEngine.score(query_fingerprints, self.fingerprint(file_id)))
+            for file_id, _ in self.candidates(query_fingerprints, top_k)
+        ]
+        result_list.sort(key=lambda r: r[1], reverse=True)
+        return result_list
+
+    # parameters stored along with the index
+    def index_params(self) -> dict:
+        params = WavFingerprint.fingerprint_params(self.sample_rate)
+        params["INDEX_VERSION"] = HashIndex.INDEX_VERSION
+        params["VALUE_BITS"] = HashIndex.VALUE_BITS
+        params["MAX_FILE_RATIO"] = HashIndex.MAX_FILE_RATIO
+        params["MIN_MAX_FILES"] = HashIndex.MIN_MAX_FILES
+        return params
+
+    def save(self, index_path: str):
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                params=np.array(json.dumps(self.index_params())),
+                entries_key=np.array(self.entries_key),
+                paths=np.array(self.paths, dtype=str),
+                n_windows=self.n_windows,
+                feature_offsets=self.feature_offsets,
+                features=self.features,
+                hashes=self.hashes,
+                file_ids=self.file_ids,
+                times=self.times,
+            )
+        os.replace(tmp_path, index_path)
+
+    # None if the index is missing, built with other params or, if entries_key is given, from other entries
+    @staticmethod
+    def load(
+        index_path: str, sample_rate: int = WavFingerprint.DEFAULT_SAMPLE_RATE, entries_key: Optional[str] = None
+    ) -> Optional["HashIndex"]:
+        if not os.path.isfile(index_path):
+            return None
+        hash_index = HashIndex(sample_rate=sample_rate)
+        with np.load(index_path, allow_pickle=False) as data:
+            if json.loads(str(data["params"])) != hash_index.index_params():
+                return None
+            hash_index.entries_key = str(data["entries_key"])
+            if entries_key is not None and hash_index.entries_key != entries_key:
+                return None
+            hash_index.paths = [str(path) for path in data["paths"]]
+            hash_index.n_windows = data["n_windows"]
+            hash_index.feature_offsets = data["feature_offsets"]
+            hash_index.features = data["features"]
+            hash_index.hashes = data["hashes"]
+            hash_index.file_ids = data["file_ids"]
+            hash_index.times = data["times"]
+        return hash_index
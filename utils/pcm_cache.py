@@ -0,0 +1,121 @@
+import os
+import hashlib
+import numpy as np
+from typing import Optional
+
+from .fingerprint import WavFingerprint
+from .profiler import profile_stage, profile_count
+from .audio_loader import load_audio_channel
+
+
+# On-disk cache of trimmed, resampled single channel PCM, one float32 .npy per (file content, channel, rate)
+# least recently used files are evicted once the cache grows over max_bytes
+# the cache size is scanned on the first put and every SCAN_INTERVAL puts, puts in between only add their own size,
+# so puts of other processes are seen by the next scan
+class PcmCache(object):
+
+    CACHE_VERSION = 1       # bump when trim / resample changes
+    CACHE_EXT = ".npy"
+    DEFAULT_MAX_BYTES = 4 << 30
+    HASH_BLOCK_SIZE = 1 << 20
+    SCAN_INTERVAL = 256     # puts between scans of the cache dir
+    EVICT_RATIO = 0.9       # a full cache is evicted down to this share of max_bytes, so puts do not scan every time
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir: str = os.path.abspath(cache_dir)
+        self.max_bytes: int = max_bytes
+        self.cached_bytes: Optional[int] = None     # estimated cache size, None before the first scan
+        self.puts_since_scan: int = 0
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    # hash of file content, independent of path and mtime
+    @staticmethod
+    def content_hash(path: str) -> str:
+        file_hash = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(PcmCache.HASH_BLOCK_SIZE), b""):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+
+    def cache_path(self, content_hash: str, channel: int, sample_rate: int) -> str:
+        return os.path.join(self.cache_dir, "%s_c%d_%d_v%d%s" % (
+            content_hash, channel, sample_rate, PcmCache.CACHE_VERSION, PcmCache.CACHE_EXT
+        ))
+
+    # memory-mapped samples, None if not cached
+    def get(self, content_hash: str, channel: int, sample_rate: int) -> Optional[np.ndarray]:
+        cache_path = self.cache_path(content_hash, channel, sample_rate)
+        try:
+            samples = np.load(cache_path, mmap_mode="r")
+            os.utime(cache_path)        # mtime is the last access time for eviction
+        except (FileNotFoundError, ValueError):
+            return None
+        return samples
+
+    def put(self, content_hash: str, channel: int, sample_rate: int, samples: np.ndarray):
+        cache_path = self.cache_path(content_hash, channel, sample_rate)
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        samples = samples.astype(np.float32)
+        with open(tmp_path, "wb") as f:
+            np.save(f, samples)
+        os.replace(tmp_path, cache_path)
+
+        self.puts_since_scan += 1
+        if self.cached_bytes is not None:
+            self.cached_bytes += samples.nbytes
+        if (
+            self.cached_bytes is None or self.cached_bytes > self.max_bytes
+            or self.puts_since_scan >= PcmCache.SCAN_INTERVAL
+        ):
+            self.evict()
+
+    # scan the cache, once it is over max_bytes remove least recently used files down to EVICT_RATIO of it
+    def evict(self):
+        cache_files = []
+        total_bytes = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(PcmCache.CACHE_EXT):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            cache_files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total_bytes += stat.st_size
+        self.cached_bytes = total_bytes
+        self.puts_since_scan = 0
+        if total_bytes <= self.max_bytes:
+            return
+
+        cache_files.sort()
+        for _, size, cache_path in cache_files:
+            try:
+                os.remove(cache_path)
+            except OSError:
+                continue    # removed by another process, or still mapped on windows
+            total_bytes -= size
+            self.cached_bytes = total_bytes
+            if total_bytes <= self.max_bytes * PcmCache.EVICT_RATIO:
+                break
+
+    # trimmed samples of one channel resampled to sample_rate, decoded only if not cached
+    def load_samples(self, path: str, sample_rate: int, channel: int = 0) -> np.ndarray:
+        with profile_stage("pcm_cache"):
+            content_hash = PcmCache.content_hash(path)
+            samples = self.get(content_hash, channel, sample_rate)
+        if samples is not None:
+            profile_count("pcm_cache_hits", 1)
+            return samples
+
+        with profile_stage("read"):
+            samples, ori_sample_rate = load_audio_channel(path, channel)
+        with profile_stage("trim"):
+            samples = WavFingerprint.trim_silence(samples)
+        if ori_sample_rate != sample_rate:
+            with profile_stage("resample"):
+                samples = WavFingerprint.resample(samples, ori_sample_rate, sample_rate)
+        samples = samples.astype(np.float32)
+        with profile_stage("pcm_cache"):
+            self.put(content_hash, channel, sample_rate, samples)
+        return samples
@@ -0,0 +1,142 @@
+import json
+import time
+import threading
+import numpy as np
+from contextlib import contextmanager
+from typing import Optional
+
+
+# Per-file stage timings and counters of the search pipeline
+class StageProfiler(object):
+
+    HISTOGRAM_EDGES = [0.001, 0.01, 0.1, 1.0, 10.0]     # seconds
+    GLOBAL_RECORD = "<global>"      # record of stages run outside of any file
+
+    def __init__(self):
+        # path -> {"stages": {stage: seconds}, "counters": {counter: value}}
+        self.file_records: dict[str, dict[str, dict[str, float]]] = {}
+        self.current_path: str = StageProfiler.GLOBAL_RECORD
+
+    # following stages and counters are recorded to path
+    def begin_file(self, path: str):
+        self.current_path = path
+
+    def end_file(self):
+        self.current_path = StageProfiler.GLOBAL_RECORD
+
+    def _record(self, path: str) -> dict[str, dict[str, float]]:
+        if path not in self.file_records:
+            self.file_records[path] = {"stages": {}, "counters": {}}
+        return self.file_records[path]
+
+    def add_time(self, stage: str, seconds: float):
+        stages = self._record(self.current_path)["stages"]
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def add_count(self, counter: str, value: float):
+        counters = self._record(self.current_path)["counters"]
+        counters[counter] = counters.get(counter, 0) + value
+
+    @contextmanager
+    def stage(self, stage: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start_time)
+
+    # remove and return the record of path, used to send worker records to the main process
+    def pop_record(self, path: str) -> Optional[dict[str, dict[str, float]]]:
+        return self.file_records.pop(path, None)
+
+    def merge_record(self, path: str, record: dict[str, dict[str, float]]):
+        target = self._record(path)
+        for key in ["stages", "counters"]:
+            for name, value in record[key].items():
+                target[key][name] = target[key].get(name, 0) + value
+
+    # aggregate of every stage over all files
+    def stage_summary(self) -> dict[str, dict]:
+        stage_times: dict[str, list[float]] = {}
+        for record in self.file_records.values():
+            for stage, seconds in record["stages"].items():
+                stage_times.setdefault(stage, []).append(seconds)
+
+        summary = {}
+        for stage, times in stage_times.items():
+            times = np.array(times)
+            histogram = np.histogram(times, bins=[0.0] + StageProfiler.HISTOGRAM_EDGES + [np.inf])[0]
+            summary[stage] = {
+                "files": int(times.size),
+                "total": float(np.sum(times)),
+                "mean": float(np.mean(times)),
+                "p50": float(np.percentile(times, 50)),
+                "p95": float(np.percentile(times, 95)),
+                "max": float(np.max(times)),
+                "histogram": histogram.tolist(),
+            }
+        return summary
+
+    def counter_summary(self) -> dict[str, float]:
+        counters: dict[str, float] = {}
+        for record in self.file_records.values():
+            for counter, value in record["counters"].items():
+                counters[counter] = counters.get(counter, 0) + value
+        return counters
+
+    def to_dict(self) -> dict:
+        return {
+            "histogram_edges": StageProfiler.HISTOGRAM_EDGES,
+            "stages": self.stage_summary(),
+            "counters": self.counter_summary(),
+            "files": self.file_records,
+        }
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self) -> str:
+        edges = ["<%gs" % edge for edge in StageProfiler.HISTOGRAM_EDGES] + [">=%gs" % StageProfiler.HISTOGRAM_EDGES[-1]]
+        lines = ["%-12s %6s %10s %10s %10s %10s %10s  %s" % (
+            "Stage", "Files", "Total(s)", "Mean(ms)", "P50(ms)", "P95(ms)", "Max(ms)", " ".join(edges)
+        )]
+        for stage, stage_summary in sorted(self.stage_summary().items(), key=lambda s: -s[1]["total"]):
+            lines.append("%-12s %6d %10.3f %10.2f %10.2f %10.2f %10.2f  %s" % (
+                stage, stage_summary["files"], stage_summary["total"],
+                stage_summary["mean"] * 1000, stage_summary["p50"] * 1000,
+                stage_summary["p95"] * 1000, stage_summary["max"] * 1000,
+                " ".join(["%d" % n for n in stage_summary["histogram"]]),
+            ))
+        for counter, value in self.counter_summary().items():
+            lines.append("%s: %d" % (counter, value))
+        return "\n".join(lines)
+
+
+# profiler of the current thread, stages are not recorded if it is None
+# per thread, so jobs running in threads of one process, e.g. gui index and search jobs, keep their records apart
+_thread_local = threading.local()
+
+
+def set_profiler(profiler: Optional[StageProfiler]):
+    _thread_local.profiler = profiler
+
+
+def get_profiler() -> Optional[StageProfiler]:
+    return getattr(_thread_local, "profiler", None)
+
+
+@contextmanager
+def profile_stage(stage: str):
+    profiler = get_profiler()
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(stage):
+        yield
+
+
+def profile_count(counter: str, value: float):
+    profiler = get_profiler()
+    if profiler is not None:
+        profiler.add_count(counter, value)
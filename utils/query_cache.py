@@ -0,0 +1,90 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Optional
+
+from .audio_loader import load_audio
+from .fingerprint import WavFingerprint
+from .profiler import profile_count
+
+
+# In-process LRU cache of query channel fingerprints, keyed by file identity and fingerprint params
+class QueryCache(object):
+
+    DEFAULT_MAX_ENTRIES = 16
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries: int = max_entries
+        self.entries: OrderedDict[tuple, list[WavFingerprint]] = OrderedDict()     # least recently used first
+        self.loading: dict[tuple, Future] = {}     # keys being decoded -> fingerprints once decoded
+        self._lock = threading.Lock()       # shared by the gui and search threads
+
+    # (abs path, size, mtime, params), a changed file or other params miss the cache
+    @staticmethod
+    def cache_key(path: str, sample_rate: int) -> tuple:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return path, stat.st_size, stat.st_mtime_ns, json.dumps(WavFingerprint.fingerprint_params(sample_rate))
+
+    def get(self, key: tuple) -> Optional[list[WavFingerprint]]:
+        with self._lock:
+            fingerprints = self.entries.get(key)
+            if fingerprints is not None:
+                self.entries.move_to_end(key)
+            return fingerprints
+
+    def put(self, key: tuple, fingerprints: list[WavFingerprint]):
+        with self._lock:
+            self.entries[key] = fingerprints
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # compact channel fingerprints of path resampled to sample_rate, decoded only if not cached
+    # concurrent loads of a key being decoded wait for that decode, its error is raised to all of them
+    def load(self, path: str, sample_rate: int = WavFingerprint.DEFAULT_SAMPLE_RATE) -> list[WavFingerprint]:
+        key = QueryCache.cache_key(path, sample_rate)
+        with self._lock:
+            fingerprints = self.entries.get(key)
+            if fingerprints is not None:
+                self.entries.move_to_end(key)
+            future = self.loading.get(key)
+            is_loader = fingerprints is None and future is None
+            if is_loader:
+                future = self.loading[key] = Future()
+        if fingerprints is not None:
+            profile_count("query_cache_hits", 1)
+            return fingerprints
+        if not is_loader:
+            fingerprints = future.result()
+            profile_count("query_cache_hits", 1)
+            return fingerprints
+
+        try:
+            audio_data = load_audio(path)
+            fingerprints = WavFingerprint.from_samples(
+                audio_data.samples,
+                audio_data.sample_rate,
+                resample_rate=sample_rate,
+                compact=True,
+            )
+        except BaseException as e:
+            with self._lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+        self.put(key, fingerprints)
+        with self._lock:
+            del self.loading[key]
+        future.set_result(fingerprints)
+        return fingerprints
+
+
+# cache shared by all callers in this process
+_query_cache = QueryCache()
+
+
+def get_query_cache() -> QueryCache:
+    return _query_cache
@@ -0,0 +1,346 @@
+import os
+import heapq
+import multiprocessing
+import numpy as np
+from typing import Optional, Iterator
+
+from .fingerprint import WavFingerprint
+from .fingerprint_index import IndexEntry, FingerprintIndex
+from .fingerprint_store import FingerprintStore
+from .pcm_cache import PcmCache
+from .profiler import StageProfiler, set_profiler, get_profiler, profile_stage
+
+
+# queries and library access of a worker, made once per worker process or per in-process search
+class _WorkerState(object):
+
+    def __init__(
+        self,
+        query_fingerprints: list[list[WavFingerprint]],
+        sample_rate: int,
+        pcm_cache: Optional[PcmCache],
+        score_thresholds,
+        profile: bool,
+        store_dir: Optional[str] = None,
+        coarse: bool = False,
+        n_peaks: int = 0,
+    ):
+        self.query_fingerprints: list[list[WavFingerprint]] = query_fingerprints    # channel fingerprints of each query
+        self.sample_rate: int = sample_rate
+        self.pcm_cache: Optional[PcmCache] = pcm_cache
+        self.score_thresholds = score_thresholds    # shared k-th best score of each query in top-k mode
+        self.coarse: bool = coarse
+        self.n_peaks: int = n_peaks
+        self.profiler: Optional[StageProfiler] = StageProfiler() if profile else None
+        self.store: Optional[FingerprintStore] = None   # mapped by each worker, pages are shared between workers
+        if store_dir is not None:
+            self.store = FingerprintStore(store_dir, sample_rate)
+            self.store.open()
+
+
+# state of the current worker process, set by _init_worker
+_worker_state: Optional[_WorkerState] = None
+
+
+def _init_worker(*args):
+    global _worker_state
+    _worker_state = _WorkerState(*args)
+    set_profiler(_worker_state.profiler)
+
+
+# pool task of a chunk, see _run_chunk
+def _run_worker_chunk(
+    chunk: list[tuple[int, str, Optional[IndexEntry], Optional[tuple[int, int]]]]
+) -> list[tuple[int, str, list[Optional[float]], Optional[list], Optional[IndexEntry], Optional[dict], Optional[str]]]:
+    return _run_chunk(_worker_state, chunk)
+
+
+# chunk of tasks: (file idx, path, indexed entry or None, (shard idx, record idx) in the store or None)
+# -> result of each task: (file idx, path, score of each query or None if it cannot reach the top k,
+#     peaks of each query or None, new entry or None, profiler record or None, decode error or None)
+# files of the chunk missing from the index are fingerprinted together, see FingerprintIndex.compute_entries
+# a file that cannot be decoded, e.g. a video without audio, scores None for every query and reports its error
+def _run_chunk(
+    state: _WorkerState, chunk: list[tuple[int, str, Optional[IndexEntry], Optional[tuple[int, int]]]]
+) -> list[tuple[int, str, list[Optional[float]], Optional[list], Optional[IndexEntry], Optional[dict], Optional[str]]]:
+    entries: list[Optional[IndexEntry]] = []
+    for _, path, entry, store_location in chunk:
+        if store_location is not None:
+            entry = state.store.entry_at(store_location[0], store_location[1], path)
+        entries.append(entry)
+    new_entries: list[Optional[IndexEntry]] = [None] * len(chunk)
+    errors: list[Optional[str]] = [None] * len(chunk)
+    missing = [task_idx for task_idx, entry in enumerate(entries) if entry is None]
+    computed = FingerprintIndex.compute_entries(
+        [chunk[task_idx][1] for task_idx in missing], state.sample_rate, state.pcm_cache
+    )
+    for task_idx, (new_entry, error) in zip(missing, computed):
+        entries[task_idx] = new_entries[task_idx] = new_entry
+        errors[task_idx] = error
+
+    profiler = state.profiler
+    results = []
+    for (file_idx, path, _, _), entry, new_entry, error in zip(chunk, entries, new_entries, errors):
+        if profiler is not None:
+            profiler.begin_file(path)
+        scores: list[Optional[float]] = [None] * len(state.query_fingerprints)
+        peak_lists = None
+        if entry is not None and len(state.query_fingerprints) > 0:
+            key_fingerprint = WavFingerprint.from_feature(entry.feature, state.sample_rate, entry.n_window)
+            min_scores = None if state.score_thresholds is None else state.score_thresholds[:]
+            with profile_stage("match"):
+                if state.n_peaks > 0:
+                    scores, peak_lists = SearchEngine.score_peaks_all(
+                        state.query_fingerprints, key_fingerprint, state.n_peaks, min_scores, state.coarse
+                    )
+                else:
+                    scores = SearchEngine.score_all(
+                        state.query_fingerprints, key_fingerprint, min_scores, state.coarse
+                    )
+
+        record = None
+        if profiler is not None:
+            profiler.end_file()
+            record = profiler.pop_record(path)
+        results.append((file_idx, path, scores, peak_lists, new_entry, record, error))
+    return results
+
+
+# Match queries against library files on a process pool, every file is decoded once for all queries
+class SearchEngine(object):
+
+    DEFAULT_CHUNK_SIZE = 8      # files handed to a worker at once
+    INDEX_CHUNK_SIZE = 64       # index_files: files handed to a worker at once, short ones are fingerprinted together
+    INDEX_CHUNKS_PER_WORKER = 4     # index_files: smaller chunks for small trees, so every worker gets some
+
+    def __init__(
+        self,
+        query_fingerprints: list[list[WavFingerprint]],    # channel fingerprints of each query
+        index: Optional[FingerprintIndex] = None,     # indexed fingerprints are reused, new ones are stored
+        n_workers: Optional[int] = None,              # None for all cpus, 1 to run in the calling process
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        sample_rate: int = WavFingerprint.DEFAULT_SAMPLE_RATE,
+        pcm_cache: Optional[PcmCache] = None,         # decoded samples cache for files not in the index
+        top_k: Optional[int] = None,                  # skip files whose score bound cannot reach the top k
+        profiler: Optional[StageProfiler] = None,     # stage timings of every file are merged into it
+        store: Optional[FingerprintStore] = None,     # stored fingerprints are mapped by workers, new ones appended
+        coarse: bool = False,     # two stage WavFingerprint.match_coarse_max instead of the exact max
+        n_peaks: int = 0,         # best offsets of each query kept in file_peaks, 0 for scores only
+    ):
+        self.query_fingerprints: list[list[WavFingerprint]] = query_fingerprints
+        self.index: Optional[FingerprintIndex] = index
+        self.n_workers: int = n_workers if n_workers is not None else os.cpu_count()
+        self.chunk_size: int = chunk_size
+        self.sample_rate: int = sample_rate
+        self.pcm_cache: Optional[PcmCache] = pcm_cache
+        self.top_k: Optional[int] = top_k
+        self.top_k_heaps: list[list[float]] = []     # best scores of each query in top-k mode
+        self.score_thresholds = None
+        self.profiler: Optional[StageProfiler] = profiler
+        self.store: Optional[FingerprintStore] = store
+        self.coarse: bool = coarse
+        self.n_peaks: int = n_peaks
+        self.file_peaks: dict[str, list[Optional[list[tuple[float, float, float, float]]]]] = {}    # path -> peaks
+        self.failed_paths: dict[str, str] = {}      # path -> decode error of the files skipped by the last search
+
+    # best score of all query channels on key, None if it is not above min_score
+    @staticmethod
+    def score(
+        query_fingerprints: list[WavFingerprint], key_fingerprint: WavFingerprint, min_score: float = -1.0
+    ) -> Optional[float]:
+        return SearchEngine.score_all([query_fingerprints], key_fingerprint, [min_score])[0]
+
+    # best score of each query on key, all channels of all queries are matched in one batched pass
+    # the score of a query is None if it is not above its min_score
+    # coarse: channels are matched one by one with the two stage matcher instead
+    @staticmethod
+    def score_all(
+        query_fingerprints: list[list[WavFingerprint]],
+        key_fingerprint: WavFingerprint,
+        min_scores: Optional[list[float]] = None,
+        coarse: bool = False,
+    ) -> list[Optional[float]]:
+        if min_scores is None:
+            min_scores = [-1.0] * len(query_fingerprints)
+        chn_fingerprints = []
+        chn_min_scores = []
+        chn_query_indices = []
+        for q_idx, q_fingerprints in enumerate(query_fingerprints):
+            chn_fingerprints += q_fingerprints
+            chn_min_scores += [min_scores[q_idx]] * len(q_fingerprints)
+            chn_query_indices += [q_idx] * len(q_fingerprints)
+
+        scores: list[Optional[float]] = [None] * len(query_fingerprints)
+        if coarse:
+            chn_scores = [
+                WavFingerprint.match_coarse_max(chn_fingerprint, key_fingerprint, chn_min_score)
+                for chn_fingerprint, chn_min_score in zip(chn_fingerprints, chn_min_scores)
+            ]
+        else:
+            chn_scores = WavFingerprint.match_max_batch(chn_fingerprints, key_fingerprint, chn_min_scores)
+        for q_idx, chn_score in zip(chn_query_indices, chn_scores):
+            if chn_score is not None and (scores[q_idx] is None or chn_score > scores[q_idx]):
+                scores[q_idx] = chn_score
+        return scores
+
+    # best score and the n_peaks best offsets of each query on key, see WavFingerprint.pick_peaks
+    # the peaks of a query are None if its score is None, only the arrays of the other queries are matched in full
+    # without min scores the full arrays of all queries are matched once and give the scores as well
+    @staticmethod
+    def score_peaks_all(
+        query_fingerprints: list[list[WavFingerprint]],
+        key_fingerprint: WavFingerprint,
+        n_peaks: int = WavFingerprint.PEAK_NUM,
+        min_scores: Optional[list[float]] = None,
+        coarse: bool = False,
+    ) -> tuple[list[Optional[float]], list[Optional[list[tuple[float, float, float, float]]]]]:
+        scores: Optional[list[Optional[float]]] = None
+        if coarse or (min_scores is not None and max(min_scores, default=-1.0) > -1.0):
+            scores = SearchEngine.score_all(query_fingerprints, key_fingerprint, min_scores, coarse)
+
+        chn_fingerprints = []
+        chn_query_indices = []
+        for q_idx, q_fingerprints in enumerate(query_fingerprints):
+            if scores is None or scores[q_idx] is not None:
+                chn_fingerprints += q_fingerprints
+                chn_query_indices += [q_idx] * len(q_fingerprints)
+        chn_similarity_arrays = WavFingerprint.match_batch(chn_fingerprints, key_fingerprint)
+
+        chn_peak_lists: list[list[tuple[float, float, float, float]]] = [[] for _ in query_fingerprints]
+        full_scores: list[Optional[float]] = [None] * len(query_fingerprints)
+        for q_idx, chn_fingerprint, similarity_array in zip(
+            chn_query_indices, chn_fingerprints, chn_similarity_arrays
+        ):
+            chn_peak_lists[q_idx] += WavFingerprint.pick_peaks(
+                similarity_array, chn_fingerprint, key_fingerprint, n_peaks
+            )
+            chn_score = float(np.max(similarity_array))
+            if full_scores[q_idx] is None or chn_score > full_scores[q_idx]:
+                full_scores[q_idx] = chn_score
+        if scores is None:
+            scores = full_scores
+
+        # best peaks of all channels, one per location
+        peak_lists: list[Optional[list[tuple[float, float, float, float]]]] = [None] * len(query_fingerprints)
+        for q_idx, chn_peak_list in enumerate(chn_peak_lists):
+            if scores[q_idx] is None:
+                continue
+            peak_list = []
+            for peak in sorted(chn_peak_list, key=lambda p: p[3], reverse=True):
+                if len(peak_list) < n_peaks and all([
+                    abs(peak[0] - kept_peak[0]) >= WavFingerprint.PEAK_DISTANCE for kept_peak in peak_list
+                ]):
+                    peak_list.append(peak)
+            peak_lists[q_idx] = peak_list
+        return scores, peak_lists
+
+    # match all paths, yield (file idx, path, score of each query) in completion order
+    # in top-k mode, the score is None for files skipped by the bound, it is None for files failing to decode as well,
+    # see failed_paths
+    def search(self, paths: list[str]) -> Iterator[tuple[int, str, list[Optional[float]]]]:
+        tasks = []
+        for file_idx, path in enumerate(paths):
+            entry = None
+            store_location = None
+            if self.store is not None:
+                path = os.path.abspath(path)
+                store_location = self.store.locate(path, os.stat(path))
+            elif self.index is not None:
+                path = os.path.abspath(path)
+                entry = self.index.entries.get(path)
+                if entry is not None and not entry.is_up_to_date(os.stat(path)):
+                    entry = None
+            tasks.append((file_idx, path, entry, store_location))
+
+        self.top_k_heaps = [[] for _ in self.query_fingerprints]
+        self.file_peaks = {}
+        self.failed_paths = {}
+        self.score_thresholds = None
+        if self.top_k is not None:
+            self.score_thresholds = multiprocessing.RawArray("d", [-1.0] * len(self.query_fingerprints))
+
+        init_args = (
+            self.query_fingerprints, self.sample_rate, self.pcm_cache, self.score_thresholds, self.profiler is not None,
+            self.store.store_dir if self.store is not None else None, self.coarse, self.n_peaks,
+        )
+        chunks = [
+            tasks[chunk_start:chunk_start + self.chunk_size] for chunk_start in range(0, len(tasks), self.chunk_size)
+        ]
+        try:
+            # in process, the state of this search is passed to each chunk, so concurrent searches do not share it
+            # the worker profiler is active only while a chunk runs, the caller may profile in between
+            if self.n_workers <= 1:
+                state = _WorkerState(*init_args)
+                for chunk in chunks:
+                    caller_profiler = get_profiler()
+                    set_profiler(state.profiler)
+                    try:
+                        results = _run_chunk(state, chunk)
+                    finally:
+                        set_profiler(caller_profiler)
+                    for result in results:
+                        yield self._collect(result)
+                return
+
+            with multiprocessing.Pool(self.n_workers, initializer=_init_worker, initargs=init_args) as pool:
+                for results in pool.imap_unordered(_run_worker_chunk, chunks):
+                    for result in results:
+                        yield self._collect(result)
+        finally:
+            if self.store is not None:
+                self.store.flush()
+
+    # fingerprint paths not in index yet on a process pool and store them into it
+    # yield (path, decode error or None) of each path once stored, failed files are not stored
+    # see FingerprintIndex.refresh, which calls it for the added and changed files of a tree
+    @staticmethod
+    def index_files(
+        index: FingerprintIndex,
+        paths: list[str],
+        n_workers: Optional[int] = None,
+        pcm_cache: Optional[PcmCache] = None,
+        profiler: Optional[StageProfiler] = None,
+    ) -> Iterator[tuple[str, Optional[str]]]:
+        if len(paths) == 0:
+            return      # no pool for an up to date index
+        n_workers = n_workers if n_workers is not None else os.cpu_count()
+        chunk_size = min(
+            SearchEngine.INDEX_CHUNK_SIZE, max(len(paths) // (n_workers * SearchEngine.INDEX_CHUNKS_PER_WORKER), 1)
+        )
+        search_engine = SearchEngine(
+            [], index=index, n_workers=n_workers, chunk_size=chunk_size, sample_rate=index.sample_rate,
+            pcm_cache=pcm_cache, profiler=profiler,
+        )
+        for _, path, _ in search_engine.search(paths):
+            yield path, search_engine.failed_paths.get(path)
+
+    # store new entry into the store or index, update the k-th best scores shared with workers, merge profiler record
+    def _collect(
+        self,
+        result: tuple[
+            int, str, list[Optional[float]], Optional[list], Optional[IndexEntry], Optional[dict], Optional[str]
+        ],
+    ) -> tuple[int, str, list[Optional[float]]]:
+        file_idx, path, scores, peak_lists, new_entry, record, error = result
+        if error is not None:
+            self.failed_paths[path] = error
+        if peak_lists is not None:
+            self.file_peaks[path] = peak_lists
+        if new_entry is not None and self.store is not None:
+            self.store.put(new_entry)
+        elif new_entry is not None and self.index is not None:
+            self.index.put(new_entry)
+        if record is not None and self.profiler is not None:
+            self.profiler.merge_record(path, record)
+        if self.score_thresholds is not None:
+            for q_idx, score in enumerate(scores):
+                if score is None:
+                    continue
+                heap = self.top_k_heaps[q_idx]
+                if len(heap) < self.top_k:
+                    heapq.heappush(heap, score)
+                else:
+                    heapq.heappushpop(heap, score)
+                if len(heap) >= self.top_k:
+                    self.score_thresholds[q_idx] = heap[0]
+        return file_idx, path, scores
@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Iterator
+
+from .fingerprint import WavFingerprint
+from .fingerprint_index import FingerprintIndex
+from .hash_index import HashIndex
+from .query_cache import get_query_cache
+
+
+# Long-running search service over one library, fingerprints stay resident between queries
+# protocol: one json object per line on a localhost tcp socket
+#   {"query": path, "top_k": 5}  -> {"rank": 1, "path": ..., "score": ...} per result, then {"done": true, "seconds": t}
+#   {"command": "refresh"}       -> rescan the library,
+#                                   {"done": true, "added": n, "changed": n, "removed": n, "failed": n}
+#   {"command": "stats"}         -> {"done": true, "files": n, "pending": n}
+# failed requests answer {"error": message}, a connection may send any number of requests
+class SearchServer(object):
+
+    DEFAULT_HOST = "127.0.0.1"
+    DEFAULT_PORT = 8765
+    DEFAULT_TOP_K = 5
+    MIN_CANDIDATES = 20         # hash index candidates scored exactly per query, at least
+    DEFAULT_MAX_PENDING = 256   # queries accepted at once, later ones wait
+
+    def __init__(
+        self,
+        root: str,
+        index_dir: Optional[str] = None,            # fingerprint index is loaded and saved here if given
+        n_workers: Optional[int] = None,            # processes fingerprinting new library files
+        n_threads: int = os.cpu_count(),            # concurrent queries
+        max_pending: int = DEFAULT_MAX_PENDING,
+        sample_rate: int = WavFingerprint.DEFAULT_SAMPLE_RATE,
+    ):
+        self.root: str = os.path.abspath(root)
+        self.index_dir: Optional[str] = index_dir
+        self.n_workers: Optional[int] = n_workers
+        self.max_pending: int = max_pending
+        self.sample_rate: int = sample_rate
+        self.index: FingerprintIndex = FingerprintIndex(self.root, sample_rate)
+        self.hash_index: HashIndex = HashIndex(sample_rate)
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=n_threads)
+        self.n_pending: int = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._refresh_lock: Optional[asyncio.Lock] = None
+        self._next_refresh: Optional[asyncio.Future] = None     # shared by refresh requests waiting for the lock
+
+    # fingerprint new and changed files, drop removed ones and rebuild the hash index if any changed
+    # not thread safe, the server runs one at a time, see _refresh
+    def refresh(self) -> dict:
+        report = self.index.sync(self.index_dir, n_workers=self.n_workers)
+        # replaced at once, queries keep the old one
+        self.hash_index = HashIndex.sync(self.index, self.index_dir, self.hash_index)
+        if len(report.failed) > 0:
+            print(report.failure_summary(), file=sys.stderr)
+        return {
+            "added": len(report.added), "changed": len(report.changed), "removed": len(report.removed),
+            "failed": len(report.failed),
+        }
+
+    # ranked [(path, score)] of the top_k library files matching the query file
+    def query(self, query_path: str, top_k: int = DEFAULT_TOP_K) -> list[tuple[str, float]]:
+        query_fingerprints = get_query_cache().load(query_path, self.sample_rate)
+        result_list = self.hash_index.search(query_fingerprints, max(top_k, SearchServer.MIN_CANDIDATES))
+        return [(path, score) for path, score in result_list if score is not None][:top_k]
+
+    # run refresh on the executor, one at a time, they share the index and its save path
+    # requests arriving during a running refresh share the next one, which still sees their changes
+    async def _refresh(self) -> dict:
+        if self._next_refresh is None:
+            self._next_refresh = asyncio.get_running_loop().create_future()
+        next_refresh = self._next_refresh
+        async with self._refresh_lock:
+            if next_refresh.done():
+                return next_refresh.result()
+            self._next_refresh = None
+            try:
+                report = await asyncio.get_running_loop().run_in_executor(self.executor, self.refresh)
+            except Exception as e:
+                next_refresh.set_exception(e)
+                next_refresh.exception()    # retrieved, waiting requests raise it as well
+                raise
+            next_refresh.set_result(report)
+            return report
+
+    # answer lines of one request
+    async def _answer(self, request: dict) -> list[dict]:
+        loop = asyncio.get_running_loop()
+        command = request.get("command", "query")
+        if command == "stats":
+            return [{"done": True, "files": len(self.hash_index.paths), "pending": self.n_pending}]
+        if command == "refresh":
+            return [dict(done=True, **await self._refresh())]
+        if command != "query" or "query" not in request:
+            raise ValueError("Unknown request: %s" % json.dumps(request))
+
+        start_time = time.perf_counter()
+        top_k = int(request.get("top_k", SearchServer.DEFAULT_TOP_K))
+        self.n_pending += 1
+        try:
+            async with self._semaphore:
+                result_list = await loop.run_in_executor(self.executor, self.query, request["query"], top_k)
+        finally:
+            self.n_pending -= 1
+        return [
+            {"rank": rank + 1, "path": path, "score": score} for rank, (path, score) in enumerate(result_list)
+        ] + [{"done": True, "seconds": time.perf_counter() - start_time}]
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    answer_lines = await self._answer(json.loads(line))
+                except Exception as e:
+                    answer_lines = [{"error": "%s: %s" % (type(e).__name__, e)}]
+                for answer_line in answer_lines:
+                    writer.write((json.dumps(answer_line) + "\n").encode("utf-8"))
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # refresh the library, then serve until cancelled
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self._semaphore = asyncio.Semaphore(self.max_pending)
+        self._refresh_lock = asyncio.Lock()
+        report = await self._refresh()
+        print("Library '%s': %d files, %s" % (self.root, len(self.hash_index.paths), report), file=sys.stderr)
+        server = await asyncio.start_server(self._handle_client, host, port)
+        print("Serving on %s:%d" % (host, port), file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+# send one request to a running server, yield its answer lines up to and including the last one
+def request_server(
+    request: dict, host: str = SearchServer.DEFAULT_HOST, port: int = SearchServer.DEFAULT_PORT
+) -> Iterator[dict]:
+    with socket.create_connection((host, port)) as sock:
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as f:
+            for line in f:
+                answer_line = json.loads(line)
+                yield answer_line
+                if answer_line.get("done") or "error" in answer_line:
+                    break
@@ -0,0 +1,266 @@
+import numpy as np
+from typing import Optional, Iterator
+
+from .fingerprint import WavFingerprint, StreamingFingerprinter, FingerprintExtractor
+from .hash_index import HashIndex
+from .audio_loader import load_audio_channel
+
+
+# A library file recognized in the stream, times in seconds from the start of the stream
+class Detection(object):
+
+    def __init__(
+        self,
+        path: str,
+        start_time: float,      # where the (silence trimmed) library file starts in the stream
+        detect_time: float,     # stream time of the chunk that completed the detection
+        similarity: float,      # best match score over the score of a perfect match of the shorter one
+        votes: int,             # offset consistent hash hits in the buffer
+    ):
+        self.path: str = path
+        self.start_time: float = start_time
+        self.detect_time: float = detect_time
+        self.similarity: float = similarity
+        self.votes: int = votes
+
+    def to_dict(self) -> dict:
+        return {
+            "path": self.path, "start": round(self.start_time, 3), "detected": round(self.detect_time, 3),
+            "similarity": round(self.similarity, 4), "votes": self.votes,
+        }
+
+
+# Recognize library files in a live pcm stream, e.g. game capture
+# chunks are fingerprinted incrementally into a rolling feature buffer of the last buffer_time seconds,
+# the buffer is voted against the hash index after every chunk, files whose votes reach min_vote_ratio of the hashes
+# of the shorter of the file and the full buffer (and at least min_votes) are matched exactly against the buffer,
+# the best offset gives the start time and a file is detected once its similarity reaches min_similarity
+# so a playing file is reported at most about buffer_time after its start plus one chunk
+# library features start on the first sample of the trimmed file, but a playback starts anywhere in the window grid
+# of the stream and features of windows a few samples off barely match, so the stream is fingerprinted n_phases times
+# with the grid shifted by window / n_phases samples each and every file is voted and matched at the phase of its
+# most votes, below min_similarity its onset is then searched sample by sample between the neighbouring phases on the
+# buffered samples, see _refine_onset
+class StreamMonitor(object):
+
+    DEFAULT_BUFFER_TIME = 3.0       # seconds of features kept and voted
+    DEFAULT_CHUNK_TIME = 0.2        # seconds of samples per chunk in feed_file
+    DEFAULT_MIN_SIMILARITY = 0.25
+    DEFAULT_MIN_VOTE_RATIO = 0.05   # loose, votes only select the files matched exactly
+    DEFAULT_MIN_VOTES = 48          # 4 rows of all octaves, keeps short buffers from matching noise
+    DEFAULT_PHASE_NUM = 4           # window grids of the stream
+    REFINE_ROWS = 6                 # _refine_onset: rows scored at each onset tried
+    REFINE_STEP = 3                 # _refine_onset: samples between the onsets tried first
+
+    def __init__(
+        self,
+        hash_index: HashIndex,
+        buffer_time: float = DEFAULT_BUFFER_TIME,
+        min_similarity: float = DEFAULT_MIN_SIMILARITY,
+        min_vote_ratio: float = DEFAULT_MIN_VOTE_RATIO,
+        min_votes: int = DEFAULT_MIN_VOTES,
+        n_phases: int = DEFAULT_PHASE_NUM,
+    ):
+        self.hash_index: HashIndex = hash_index
+        self.sample_rate: int = hash_index.sample_rate     # chunks are expected at the library rate
+        self.min_similarity: float = min_similarity
+        self.min_vote_ratio: float = min_vote_ratio
+        self.min_votes: int = min_votes
+        self.buffer_rows: int = max(
+            int(round(buffer_time / WavFingerprint.WINDOW_TIME)), WavFingerprint.MATCH_WINDOW_NUM
+        )
+
+        # phase p skips the first phase_shifts[p] samples of the stream, one fingerprinter and buffer each
+        self.fingerprinters: list[StreamingFingerprinter] = [
+            StreamingFingerprinter(self.sample_rate) for _ in range(n_phases)
+        ]
+        self.n_samples_per_window: int = self.fingerprinters[0].extractor.n_samples_per_window
+        self.phase_shifts: list[int] = [
+            phase_idx * self.n_samples_per_window // n_phases for phase_idx in range(n_phases)
+        ]
+        self.buffers: list[np.ndarray] = [
+            np.zeros((0, WavFingerprint.OCTAVE_NUM), dtype=WavFingerprint.FEATURE_DTYPE) for _ in range(n_phases)
+        ]
+        self.n_samples: int = 0     # samples pushed
+
+        # samples of the buffers, from stream sample samples_start
+        self.samples: np.ndarray = np.zeros((0,))
+        self.samples_start: int = 0
+        self.max_buffer_samples: int = (self.buffer_rows + 2) * self.n_samples_per_window
+
+        # votes needed by each file, hashes of the file against hashes of a full buffer
+        n_file_hashes = np.diff(hash_index.feature_offsets) - WavFingerprint.MATCH_WINDOW_NUM + 1
+        n_buffer_hashes = self.buffer_rows - WavFingerprint.MATCH_WINDOW_NUM + 1
+        self.file_min_votes: np.ndarray = np.maximum(
+            min_vote_ratio * np.minimum(n_file_hashes, n_buffer_hashes) * WavFingerprint.OCTAVE_NUM, min_votes
+        )
+        self._start_times: dict[int, float] = {}    # file id -> stream time of its last detected start
+        self._refined_onsets: dict[int, tuple[int, int]] = {}     # file id -> (onset, refined onset), _refine_onset
+
+    # stream time of the samples pushed so far, seconds
+    @property
+    def stream_time(self) -> float:
+        return self.n_samples / self.sample_rate
+
+    # push a chunk of 1d samples at the library rate -> files detected with it
+    def push(self, samples: np.ndarray) -> list[Detection]:
+        chunk_start = self.n_samples
+        self.n_samples += samples.shape[0]
+        self.samples = np.concatenate([self.samples, samples])
+        if self.samples.shape[0] > self.max_buffer_samples:
+            self.samples_start += self.samples.shape[0] - self.max_buffer_samples
+            self.samples = self.samples[-self.max_buffer_samples:]
+        new_rows = False
+        for phase_idx, fingerprinter in enumerate(self.fingerprinters):
+            rows = fingerprinter.push(samples[max(self.phase_shifts[phase_idx] - chunk_start, 0):])
+            if rows.shape[0] > 0:
+                self.buffers[phase_idx] = np.concatenate([self.buffers[phase_idx], rows])[-self.buffer_rows:]
+                new_rows = True
+        if not new_rows:
+            return []
+
+        # votes of every phase, each file is matched at the phase of its most votes
+        buffer_fingerprints = [self.buffer_fingerprint(phase_idx) for phase_idx in range(len(self.buffers))]
+        file_phases: dict[int, tuple[int, int]] = {}    # file id -> (votes, phase)
+        for phase_idx, buffer_fingerprint in enumerate(buffer_fingerprints):
+            if buffer_fingerprint is None:
+                continue
+            for file_id, votes in self.hash_index.vote(buffer_fingerprint).items():
+                if votes > file_phases.get(file_id, (-1, 0))[0]:
+                    file_phases[file_id] = (votes, phase_idx)
+
+        detections = []
+        for file_id, (votes, phase_idx) in file_phases.items():
+            if votes < self.file_min_votes[file_id]:
+                continue
+
+            # offset: time of the file where the buffer starts
+            buffer_fingerprint = buffer_fingerprints[phase_idx]
+            file_fingerprint = self.hash_index.fingerprint(file_id)
+            peaks = WavFingerprint.match_peaks(buffer_fingerprint, file_fingerprint, n_peaks=1)
+            n_rows = min(buffer_fingerprint.feature.shape[0], file_fingerprint.feature.shape[0])
+            n_rows -= WavFingerprint.MATCH_WINDOW_NUM - 1
+            if len(peaks) == 0:
+                continue
+            offset, _, _, score = peaks[0]
+            max_score = n_rows * WavFingerprint.OCTAVE_NUM * WavFingerprint.OCTAVE_NUM
+            start_time = self.buffer_start_time(phase_idx) - offset
+            last_start_time = self._start_times.get(file_id)
+            if score < self.min_similarity * max_score and not self._same_playback(start_time, last_start_time):
+                onset, score = self._refine_onset(file_id, int(round(start_time * self.sample_rate)))
+                start_time = onset / self.sample_rate
+            similarity = score / max_score
+            if similarity < self.min_similarity:
+                continue
+
+            self._start_times[file_id] = start_time
+            if self._same_playback(start_time, last_start_time):
+                continue    # already reported
+            detections.append(Detection(
+                path=self.hash_index.paths[file_id],
+                start_time=start_time,
+                detect_time=self.stream_time,
+                similarity=similarity,
+                votes=votes,
+            ))
+        detections.sort(key=lambda d: d.similarity, reverse=True)
+        return detections
+
+    # feed a recorded file chunk by chunk as if it was captured live, first channel only
+    # -> detections in stream order
+    def feed_file(self, path: str, chunk_time: float = DEFAULT_CHUNK_TIME) -> Iterator[Detection]:
+        samples, sample_rate = load_audio_channel(path, channel=0)
+        if sample_rate != self.sample_rate:
+            samples = WavFingerprint.resample(samples, sample_rate, self.sample_rate)
+        chunk_len = max(int(chunk_time * self.sample_rate), 1)
+        for chunk_start in range(0, samples.shape[0], chunk_len):
+            for detection in self.push(samples[chunk_start:chunk_start + chunk_len]):
+                yield detection
+
+    @staticmethod
+    def _same_playback(start_time: float, last_start_time: Optional[float]) -> bool:
+        return last_start_time is not None and abs(start_time - last_start_time) <= WavFingerprint.PEAK_DISTANCE
+
+    # best aligned onset sample of file_id within the phase spacing around onset, scored on the buffered samples
+    # windows a few samples off the onset already lose most matches, so onsets are tried every REFINE_STEP samples
+    # and then every sample around the best one, on its first REFINE_ROWS rows in the buffer, and the best one is
+    # scored on all of them -> (onset, score)
+    # a file is voted at the same onset chunk after chunk, the refined onset is kept once it was tried on
+    # REFINE_ROWS rows and only that one is scored again
+    def _refine_onset(self, file_id: int, onset: int) -> tuple[int, float]:
+        refined_onset = self._refined_onsets.get(file_id, (None, onset))
+        if refined_onset[0] == onset:
+            best_onset = refined_onset[1]
+        else:
+            radius = self.n_samples_per_window // len(self.fingerprinters)
+            step = StreamMonitor.REFINE_STEP
+            best_onset, _ = self._best_onset(file_id, range(onset - radius, onset + radius + 1, step))
+            if best_onset is None:
+                return onset, 0.0
+            best_onset, n_rows = self._best_onset(file_id, range(best_onset - step // 2, best_onset + step // 2 + 1))
+            if n_rows == StreamMonitor.REFINE_ROWS + WavFingerprint.MATCH_WINDOW_NUM - 1:
+                self._refined_onsets[file_id] = (onset, best_onset)
+
+        first_row, end_row = self._buffered_rows(file_id, best_onset)
+        if end_row - first_row < WavFingerprint.MATCH_WINDOW_NUM:
+            return best_onset, 0.0
+        feature = FingerprintExtractor.get(self.sample_rate).extract(
+            self._window_samples(best_onset, first_row, end_row)
+        )
+        file_feature = self.hash_index.fingerprint(file_id).feature
+        return best_onset, StreamMonitor._aligned_score(feature, file_feature[first_row:end_row])
+
+    # onset of the best score on the first REFINE_ROWS buffered rows -> (onset, rows scored), (None, 0) if none has
+    # enough rows
+    def _best_onset(self, file_id: int, onsets: range) -> tuple[Optional[int], int]:
+        n_sweep_rows = StreamMonitor.REFINE_ROWS + WavFingerprint.MATCH_WINDOW_NUM - 1
+        swept_onsets, row_ranges = [], []
+        for onset in onsets:
+            first_row, end_row = self._buffered_rows(file_id, onset)
+            end_row = min(end_row, first_row + n_sweep_rows)
+            if end_row - first_row >= WavFingerprint.MATCH_WINDOW_NUM:
+                swept_onsets.append(onset)
+                row_ranges.append((first_row, end_row))
+        if len(swept_onsets) == 0:
+            return None, 0
+
+        file_feature = self.hash_index.fingerprint(file_id).feature
+        features = FingerprintExtractor.get(self.sample_rate).extract_batch([
+            self._window_samples(onset, first_row, end_row)
+            for onset, (first_row, end_row) in zip(swept_onsets, row_ranges)
+        ])
+        best_idx = int(np.argmax([
+            StreamMonitor._aligned_score(feature, file_feature[first_row:end_row])
+            for feature, (first_row, end_row) in zip(features, row_ranges)
+        ]))
+        return swept_onsets[best_idx], row_ranges[best_idx][1] - row_ranges[best_idx][0]
+
+    # full windows of file_id starting at onset inside the buffered samples -> [first row, end row)
+    def _buffered_rows(self, file_id: int, onset: int) -> tuple[int, int]:
+        first_row = max(-((onset - self.samples_start) // self.n_samples_per_window), 0)
+        n_rows = (self.samples_start + self.samples.shape[0] - onset) // self.n_samples_per_window - first_row
+        return first_row, first_row + max(min(n_rows, int(self.hash_index.n_windows[file_id]) - first_row), 0)
+
+    def _window_samples(self, onset: int, first_row: int, end_row: int) -> np.ndarray:
+        start = onset + first_row * self.n_samples_per_window - self.samples_start
+        return self.samples[start:start + (end_row - first_row) * self.n_samples_per_window]
+
+    # matched fingerprint cells of two features of the same windows, see WavFingerprint._match_planes_batch
+    @staticmethod
+    def _aligned_score(feature_a: np.ndarray, feature_b: np.ndarray) -> float:
+        matched = feature_a == feature_b
+        head_count = np.count_nonzero(matched[:-2], axis=1)
+        tail_count = np.count_nonzero(matched[1:-1] & matched[2:], axis=1)
+        return float(np.sum(head_count * tail_count))
+
+    # stream time where the buffer of phase_idx starts, seconds
+    def buffer_start_time(self, phase_idx: int = 0) -> float:
+        n_rows = self.fingerprinters[phase_idx].n_rows - self.buffers[phase_idx].shape[0]
+        return self.phase_shifts[phase_idx] / self.sample_rate + n_rows * WavFingerprint.WINDOW_TIME
+
+    # buffered features of phase_idx as a fingerprint, None before the first rows
+    def buffer_fingerprint(self, phase_idx: int = 0) -> Optional[WavFingerprint]:
+        buffer = self.buffers[phase_idx]
+        if buffer.shape[0] < WavFingerprint.MATCH_WINDOW_NUM:
+            return None
+        return WavFingerprint.from_feature(buffer, self.sample_rate, buffer.shape[0])
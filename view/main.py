@@ -1,32 +1,39 @@
 import os
-import glob
-import numpy as np
-from typing import Optional, Callable
+from typing import Optional
 
 from PySide6.QtWidgets import QMainWindow, QFileDialog
 from PySide6.QtGui import QDesktopServices, QTextCursor
-from PySide6.QtCore import QUrl, Qt
+from PySide6.QtCore import QUrl, Qt, QTimer
 
 from .ui.main_window import Ui_MainWindow
-from .utils.async_task import AsyncTaskThread
-from utils.audio_loader import AudioData, soundfile_loader, moviepy_loader
+from .utils.job_scheduler import Job, JobScheduler
+from utils.audio_loader import AudioInfo, LOADER_DICT, probe_audio
 from utils.fingerprint import WavFingerprint
+from utils.fingerprint_index import FingerprintIndex, RefreshReport
+from utils.search_engine import SearchEngine
+from utils.pcm_cache import PcmCache
+from utils.profiler import StageProfiler, set_profiler
+from utils.query_cache import get_query_cache
 
 
-# Loader for different ext
-LOADER_DICT: dict[str, Callable[[str], AudioData]] = {
-    ".wav": soundfile_loader,
-    ".mp3": soundfile_loader,
-    ".mov": moviepy_loader,
-    ".mp4": moviepy_loader,
-    ".avi": moviepy_loader,
-    ".flv": moviepy_loader,
-    ".mkv": moviepy_loader,
-}
-
 # Output path
 OUTPUT_PATH = os.path.abspath("./result")
 
+# Fingerprint index path
+INDEX_PATH = os.path.join(OUTPUT_PATH, "index")
+
+# Search worker process num, None for all cpus
+SEARCH_WORKER_NUM = None
+
+# Keep only the best K results in the csv, files that cannot reach them are skipped early. None for all
+SEARCH_TOP_K = None
+
+# Record per-file stage timings, the summary is printed and dumped to json when the search finishes
+PROFILE_SEARCH = True
+
+# Decoded samples cache path, None to disable, e.g. os.path.join(OUTPUT_PATH, "pcm_cache")
+PCM_CACHE_PATH = None
+
 
 class MainWindow(QMainWindow, Ui_MainWindow):
 
@@ -39,7 +46,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         # input file info
         self.input_file_path = None     # clear input path
         self.input_file_available = False
-        self.input_file_data: Optional[AudioData] = None
+        self.input_file_info: Optional[AudioInfo] = None     # header only, samples are decoded by the search task
         self.input_fingerprints: list[WavFingerprint] = []
         self.pushButtonBrowseInput.clicked.connect(self.on_click_browse_input)
 
@@ -47,7 +54,18 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.searching_path = None      # clear searching path
         self.searching_path_available = False
         self.pushButtonBrowseSearching.clicked.connect(self.on_click_browse_searching)
-        self.searching_path_file_result: dict[str, int] = {}
+        self.searching_path_file_result: dict[str, Optional[float]] = {}
+        self.fingerprint_index: Optional[FingerprintIndex] = None
+        self.searching_matched_num = 0
+
+        # background jobs, their results are delivered to the gui thread in batches by the timer
+        self.job_scheduler = JobScheduler()
+        self.job_timer = QTimer(self)
+        self.job_timer.setInterval(JobScheduler.FLUSH_INTERVAL_MS)
+        self.job_timer.timeout.connect(self.job_scheduler.flush)
+        self.job_timer.start()
+        self.index_job: Optional[Job] = None
+        self.search_job: Optional[Job] = None
 
         # run searching panel
         self.on_update_progress(0.0)
@@ -92,12 +110,12 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.set_component_color(self.lineEditInputFile, "success")
         self.set_component_color(self.pushButtonBrowseInput, "success")
 
-        # show abstract audio data
-        audio_data = LOADER_DICT[os.path.splitext(path)[1].lower()](path)
-        self.lineEditInputChannel.setText(str(audio_data.channels))
-        self.lineEditInputSampleRate.setText(str(audio_data.sample_rate))
-        self.lineEditInputDuration.setText("%.3f" % audio_data.duration)
-        self.input_file_data = audio_data
+        # show abstract audio info
+        audio_info = probe_audio(path)
+        self.lineEditInputChannel.setText(str(audio_info.channels))
+        self.lineEditInputSampleRate.setText(str(audio_info.sample_rate))
+        self.lineEditInputDuration.setText("%.3f" % audio_info.duration)
+        self.input_file_info = audio_info
 
     # pushButtonBrowseInput clicked
     def on_click_browse_input(self):
@@ -143,10 +161,13 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         # show abstract dir info
         self.searching_path_file_result = {
             path: 0
-            for path in list(glob.glob(os.path.join(path, "**", "*.wav"), recursive=True))
+            for path in FingerprintIndex.scan_files(path)
         }
         self.lineEditSearchWavNum.setText(str(len(self.searching_path_file_result)))
 
+        # fingerprint the library ahead of the first search
+        self.start_index_job()
+
     # pushButtonBrowseSearching clicked
     def on_click_browse_searching(self):
         default_path = self.searching_path
@@ -161,78 +182,189 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     def on_update_progress(self, progress: float):
         self.progressBar.setValue(int(progress * 100))
 
+    # fingerprint new and changed library files in the background, a search preempts it and it resumes after
+    def start_index_job(self):
+        if self.index_job is not None:
+            self.index_job.cancel()
+        self.fingerprint_index = MainWindow.create_fingerprint_index(self.searching_path)
+        self.index_job = self.job_scheduler.submit(Job(
+            task_worker=self.generate_index_task(),
+            task_args=[self.fingerprint_index],
+            priority=Job.PRIORITY_BACKGROUND,
+            preemptible=True,
+            on_finish=self.on_index_job_finished,
+            name="index",
+        ))
+
+    # generate an index task closure, restartable: indexed files are skipped by the refresh
+    def generate_index_task(self):
+
+        def index_task(fingerprint_index: FingerprintIndex):
+            MainWindow.load_fingerprint_index(fingerprint_index)
+            refresh_report = RefreshReport()
+            for _ in fingerprint_index.iter_refresh(refresh_report, n_workers=SEARCH_WORKER_NUM):
+                yield None
+            if len(refresh_report.failed) > 0:
+                print(refresh_report.failure_summary())
+
+        return index_task
+
+    # empty index of root, new fingerprints go through the samples cache if enabled
+    @staticmethod
+    def create_fingerprint_index(root: str) -> FingerprintIndex:
+        return FingerprintIndex(root, pcm_cache=PcmCache(PCM_CACHE_PATH) if PCM_CACHE_PATH is not None else None)
+
+    # load the stored index once
+    @staticmethod
+    def load_fingerprint_index(fingerprint_index: FingerprintIndex):
+        index_path = FingerprintIndex.default_index_path(fingerprint_index.root, INDEX_PATH)
+        if len(fingerprint_index.entries) == 0 and fingerprint_index.load(index_path):
+            print("Loaded %d indexed fingerprints." % len(fingerprint_index.entries))
+
+    # index job finished, cancelled or failed
+    def on_index_job_finished(self, job: Job):
+        if job.state == Job.STATE_FAILED:
+            print("[ERROR]Indexing failed: %s" % job.error)
+        fingerprint_index = job.task_args[0]
+        search_running = self.search_job is not None and not self.search_job.finished
+        if job.state == Job.STATE_DONE and fingerprint_index.modified and not search_running:
+            index_path = FingerprintIndex.default_index_path(fingerprint_index.root, INDEX_PATH)
+            fingerprint_index.save(index_path)
+            print("Library indexed, %d fingerprints saved to '%s'." % (len(fingerprint_index.entries), index_path))
+
+    # lock the inputs while searching, the run button cancels the search
+    def set_searching(self, searching: bool):
+        self.groupBox.setEnabled(not searching)
+        self.groupBox_2.setEnabled(not searching)
+        self.pushButtonRun.setText("Cancel" if searching else "Search")
+
     # pushButtonRun clicked
     def on_click_run_searching(self):
+        if self.search_job is not None and not self.search_job.finished:
+            print()
+            print("Cancelling search...")
+            self.search_job.cancel()
+            return
         if not (self.input_file_available and self.searching_path_available):
             print("[ERROR]Input File or Searching Path not available.")
             return
 
         # prepare gui
         self.on_update_progress(0.0)
-        self.setEnabled(False)
-        print("Parsing input file...")
-
-        # generate input fingerprints
-        self.input_fingerprints = []
-        for q_chn_idx in range(self.input_file_data.channels):
-            samples = self.input_file_data.samples[:, q_chn_idx]
-            ori_sample_rate = self.input_file_data.sample_rate
-            samples = WavFingerprint.trim_silence(samples)
-            samples = WavFingerprint.resample(samples, ori_sample_rate, WavFingerprint.DEFAULT_SAMPLE_RATE)
-            self.input_fingerprints.append(WavFingerprint(samples, WavFingerprint.DEFAULT_SAMPLE_RATE))
-
-        # start search thread
+        self.set_searching(True)
+        if self.fingerprint_index is None:
+            self.fingerprint_index = MainWindow.create_fingerprint_index(self.searching_path)
+
+        # start search job, the index job waits until it is done
         print("Start searching...")
-        search_thread = AsyncTaskThread(
+        self.searching_matched_num = 0
+        self.search_job = Job(
             task_worker=self.generate_search_task(),
             task_args=[],
             task_length=len(self.searching_path_file_result),
+            priority=Job.PRIORITY_INTERACTIVE,
             on_progress=self.on_update_progress,
-            on_task_result=self.on_file_matched,
-            on_finish=self.on_search_thread_finished,
-            parent=self
+            on_results=self.on_files_matched,
+            on_finish=self.on_search_job_finished,
+            name="search",
         )
-        search_thread.start()
-
-    # generate a task closure
+        # each search records into its own profiler, a cancelled search still running does not mix into the next one
+        self.search_job.task_args = [
+            self.search_job, self.input_file_path, self.fingerprint_index, list(self.searching_path_file_result.keys()),
+            StageProfiler() if PROFILE_SEARCH else None,
+        ]
+        self.job_scheduler.submit(self.search_job)
+
+    # generate a search task closure
     def generate_search_task(self):
 
-        def search_task() -> tuple[int, str, int]:
-            for wav_idx, key_wav_path in enumerate(self.searching_path_file_result.keys()):
-                key_fingerprint = WavFingerprint.load_file(
-                    path=key_wav_path,
-                    resample_rate=WavFingerprint.DEFAULT_SAMPLE_RATE,
-                    selected_channels=[0],
-                )[0]
-                scores = np.array([
-                    WavFingerprint.match(q_chn_fingerprint, key_fingerprint)
-                    for q_chn_fingerprint in self.input_fingerprints
-                ])
-                yield wav_idx, key_wav_path, np.max(scores)
+        def search_task(
+            job: Job,
+            input_file_path: str,
+            fingerprint_index: FingerprintIndex,
+            key_paths: list[str],
+            search_profiler: Optional[StageProfiler],
+        ) -> tuple[int, str, float]:
+
+            # decode and fingerprint input file in the search thread, reused across searches while it is unchanged
+            print("Parsing input file...")
+            set_profiler(search_profiler)
+            if search_profiler is not None:
+                search_profiler.begin_file(input_file_path)
+            self.input_fingerprints = get_query_cache().load(input_file_path, WavFingerprint.DEFAULT_SAMPLE_RATE)
+            if search_profiler is not None:
+                search_profiler.end_file()
+            set_profiler(None)
+
+            # fingerprint new and changed files of searching path, counted as steps of the progress
+            MainWindow.load_fingerprint_index(fingerprint_index)
+            refresh_report = RefreshReport()
+            for fingerprinted_num, _ in enumerate(fingerprint_index.iter_refresh(
+                refresh_report, key_paths, n_workers=SEARCH_WORKER_NUM, profiler=search_profiler
+            )):
+                if fingerprinted_num == 0:
+                    job.add_steps(len(refresh_report.outdated))
+                yield None
+            print("Index refresh: %s" % refresh_report.summary())
+
+            # files that cannot be decoded are not matched, they stay out of the result
+            if len(refresh_report.failed) > 0:
+                print(refresh_report.failure_summary())
+            for wav_idx, key_wav_path in enumerate(key_paths):
+                if key_wav_path in refresh_report.failed:
+                    yield wav_idx, key_wav_path, None
+            key_paths = [path for path in key_paths if path not in refresh_report.failed]
+
+            search_engine = SearchEngine(
+                query_fingerprints=[self.input_fingerprints],
+                index=fingerprint_index,
+                n_workers=SEARCH_WORKER_NUM,
+                top_k=SEARCH_TOP_K,
+                profiler=search_profiler,
+            )
+            for wav_idx, key_wav_path, scores in search_engine.search(key_paths):
+                yield wav_idx, key_wav_path, scores[0]
 
         return search_task
 
-    # match with one file in search thread
-    def on_file_matched(self, match_info: tuple[int, str, int]):
-        file_idx = match_info[0]
-        file_path = match_info[1]
-        match_score = match_info[2]
+    # files matched by the search job since the last timer tick
+    def on_files_matched(self, match_info_list: list[tuple[int, str, float]]):
+        for _, file_path, match_score in match_info_list:
+            self.searching_path_file_result[file_path] = match_score     # None if skipped in top-k mode or undecodable
+        self.searching_matched_num += len(match_info_list)     # results arrive in completion order
         print("\r[%d/%d]%s" % (
-            file_idx + 1, len(self.searching_path_file_result), os.path.basename(file_path)
+            self.searching_matched_num, len(self.searching_path_file_result),
+            os.path.basename(match_info_list[-1][1]),
         ), end="")
-        self.searching_path_file_result[file_path] = match_score
 
-    # search thread finished
-    def on_search_thread_finished(self):
+    # search job finished, cancelled or failed
+    def on_search_job_finished(self, job: Job):
 
-        # output result
+        # fingerprints computed so far are kept in any case
         print()
+        fingerprint_index = job.task_args[2]
+        if fingerprint_index.modified:
+            index_path = FingerprintIndex.default_index_path(fingerprint_index.root, INDEX_PATH)
+            fingerprint_index.save(index_path)
+            print("Fingerprint index saved to '%s'." % index_path)
+        if job.state != Job.STATE_DONE:
+            if job.state == Job.STATE_FAILED:
+                print("[ERROR]Search failed: %s" % job.error)
+            else:
+                print("Search cancelled.")
+            self.on_update_progress(0.0)
+            self.set_searching(False)
+            return
+
+        # output result
         print("Search finished.")
         result_output_path = os.path.join(
             OUTPUT_PATH,
             os.path.splitext(os.path.basename(self.input_file_path))[0] + ".csv"
         )
-        result_list = [(path, score) for path, score in self.searching_path_file_result.items()]
+        result_list = [
+            (path, score) for path, score in self.searching_path_file_result.items() if score is not None
+        ]
         result_list.sort(key=lambda r: r[1], reverse=True)
         with open(result_output_path, "w") as f:
             print("Path,Score", file=f)
@@ -245,9 +377,25 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 path, score = result_list[result_idx]
                 print("Score: %d, Path: %s" % (score, path))
 
+        # output profile
+        search_profiler = job.task_args[4]
+        if search_profiler is not None:
+            print("Search Profile:")
+            print(search_profiler.summary())
+            profile_output_path = os.path.splitext(result_output_path)[0] + "_profile.json"
+            search_profiler.dump(profile_output_path)
+            print("Profile saved to '%s'." % profile_output_path)
+
         # restore gui
         self.on_update_progress(1.0)
-        self.setEnabled(True)
+        self.set_searching(False)
+
+    # stop background jobs before the window goes away, a job in the middle of a long step is not waited for
+    def closeEvent(self, event):
+        self.job_timer.stop()
+        if not self.job_scheduler.shutdown():
+            print("Background jobs still running are stopped on exit.")
+        super(MainWindow, self).closeEvent(event)
 
     # update lineEditOutputFolder
     def on_output_path_updated(self):
@@ -0,0 +1,228 @@
+import time
+import heapq
+import threading
+import itertools
+from typing import Optional, Callable
+
+
+_END = object()     # end of a job generator
+
+
+# A generator task run by JobScheduler, every yielded item is one step, items other than None are results
+class Job(object):
+
+    PRIORITY_INTERACTIVE = 0    # user queries, started first
+    PRIORITY_BACKGROUND = 10    # indexing
+
+    STATE_QUEUED = "queued"
+    STATE_RUNNING = "running"
+    STATE_DONE = "done"
+    STATE_CANCELLED = "cancelled"
+    STATE_FAILED = "failed"
+
+    def __init__(
+        self,
+        task_worker: Callable,      # python generator function
+        task_args: list,            # task_worker args
+        task_length: int = 0,       # steps, for the progress, 0 if unknown
+        priority: int = PRIORITY_BACKGROUND,
+        preemptible: bool = False,  # stopped and queued again when a more urgent job is submitted, must be restartable
+        on_progress: Optional[Callable] = None,     # (progress 0.0-1.0)
+        on_results: Optional[Callable] = None,      # (results since the last delivery)
+        on_finish: Optional[Callable] = None,       # (job), see state and error
+        name: str = "",
+    ):
+        self.task_worker: Callable = task_worker
+        self.task_args: list = task_args
+        self.task_length: int = task_length
+        self.priority: int = priority
+        self.preemptible: bool = preemptible
+        self.on_progress: Optional[Callable] = on_progress
+        self.on_results: Optional[Callable] = on_results
+        self.on_finish: Optional[Callable] = on_finish
+        self.name: str = name
+
+        self.state: str = Job.STATE_QUEUED
+        self.error: Optional[BaseException] = None
+        self.n_steps: int = 0                       # steps done by the current run
+        self._added_steps: int = 0                  # by add_steps in the current run
+        self._results: list = []                    # not delivered yet
+        self._delivered_steps: int = -1
+        self._lock = threading.Lock()               # steps and results, shared by the job and gui threads
+        self._stop = threading.Event()              # the job thread stops at its next step
+        self._cancelled: bool = False
+        self._preempted: bool = False
+
+    # stop the job at its next step, or drop it from the queue, on_finish still follows with STATE_CANCELLED
+    def cancel(self):
+        self._cancelled = True
+        self._stop.set()
+
+    # more steps than task_length, called by the task once it knows them, e.g. files to fingerprint first
+    def add_steps(self, n_steps: int):
+        with self._lock:
+            self.task_length += n_steps
+            self._added_steps += n_steps
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    @property
+    def finished(self) -> bool:
+        return self.state in [Job.STATE_DONE, Job.STATE_CANCELLED, Job.STATE_FAILED]
+
+    # called on the job thread for every yielded item
+    def _push(self, item):
+        with self._lock:
+            self.n_steps += 1
+            if item is not None:
+                self._results.append(item)
+
+    # restart from the beginning after preemption
+    def _reset(self):
+        with self._lock:
+            self.n_steps = 0
+            self.task_length -= self._added_steps
+            self._added_steps = 0
+            self._results = []
+            self._delivered_steps = -1
+        self._preempted = False
+        self._stop.clear()
+        self.state = Job.STATE_QUEUED
+
+    # pending results and progress to the callbacks, on the gui thread
+    def _deliver(self):
+        with self._lock:
+            results, self._results = self._results, []
+            n_steps = self.n_steps
+            task_length = self.task_length
+        if len(results) > 0 and self.on_results is not None:
+            self.on_results(results)
+        if n_steps != self._delivered_steps and self.on_progress is not None and task_length > 0:
+            self._delivered_steps = n_steps
+            self.on_progress(min(n_steps / task_length, 1.0))
+
+
+# Runs jobs on a pool of threads by priority, lower values first
+# job threads only buffer their results, flush() delivers them and calls on_finish on the calling thread,
+# the gui calls it from a QTimer every FLUSH_INTERVAL_MS so a large scan costs one event per tick, not per file
+# a submitted job preempts running preemptible jobs of lower priority, they are stopped at their next step and
+# queued again, queued jobs wait until the preempted ones have stopped, preemptible jobs wait while a job of
+# higher priority runs
+class JobScheduler(object):
+
+    DEFAULT_MAX_WORKERS = 2
+    FLUSH_INTERVAL_MS = 100
+    DEFAULT_SHUTDOWN_TIMEOUT = 2.0      # seconds shutdown waits for all job threads together
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS):
+        self.max_workers: int = max_workers
+        self._queue: list[tuple[int, int, Job]] = []    # heap of (priority, submit order, job)
+        self._submit_order = itertools.count()
+        self._running: list[Job] = []
+        self._finished: list[Job] = []      # finished since the last flush
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(self, job: Job) -> Job:
+        with self._lock:
+            job.state = Job.STATE_QUEUED
+            heapq.heappush(self._queue, (job.priority, next(self._submit_order), job))
+            for running_job in self._running:
+                if running_job.preemptible and running_job.priority > job.priority and not running_job.cancelled:
+                    running_job._preempted = True
+                    running_job._stop.set()
+            self._dispatch()
+        return job
+
+    # jobs queued or running
+    def pending_jobs(self) -> list[Job]:
+        with self._lock:
+            return list(self._running) + [job for _, _, job in sorted(self._queue)]
+
+    def cancel_all(self):
+        for job in self.pending_jobs():
+            job.cancel()
+        with self._lock:
+            self._dispatch()
+
+    # cancel everything and wait for the job threads up to timeout in total, None to wait until they stop, on exit
+    # -> True if all of them stopped, a thread still in a long step is a daemon and left to the process exit,
+    # whose multiprocessing finalizers terminate the process pool it waits on
+    def shutdown(self, timeout: Optional[float] = DEFAULT_SHUTDOWN_TIMEOUT) -> bool:
+        self.cancel_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        threads = list(self._threads)
+        for thread in threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0.0))
+        return not any([thread.is_alive() for thread in threads])
+
+    # deliver results, progress and finished jobs, on the gui thread
+    def flush(self):
+        with self._lock:
+            running_jobs = list(self._running)
+            finished_jobs, self._finished = self._finished, []
+        for job in running_jobs + finished_jobs:
+            job._deliver()
+        for job in finished_jobs:
+            if job.on_finish is not None:
+                job.on_finish(job)
+
+    # start queued jobs on free threads, lock held
+    def _dispatch(self):
+        for _, _, job in self._queue:
+            if job.cancelled:
+                job.state = Job.STATE_CANCELLED
+                self._finished.append(job)
+        self._queue = [entry for entry in self._queue if not entry[2].cancelled]
+        if any([running_job._preempted for running_job in self._running]):
+            return      # preempted jobs release their thread first
+
+        waiting = []    # stays sorted, so still a heap
+        for entry in sorted(self._queue):
+            job = entry[2]
+            if len(self._running) >= self.max_workers or (
+                job.preemptible and any([running_job.priority < job.priority for running_job in self._running])
+            ):
+                waiting.append(entry)
+                continue
+            job.state = Job.STATE_RUNNING
+            self._running.append(job)
+            thread = threading.Thread(target=self._run, args=(job,), name="job-%s" % job.name, daemon=True)
+            self._threads.append(thread)
+            thread.start()
+        self._queue = waiting
+
+    # job thread, closing the generator runs its finally blocks, e.g. process pools are terminated
+    def _run(self, job: Job):
+        exhausted = False
+        try:
+            generator = job.task_worker(*job.task_args)
+            try:
+                while not job._stop.is_set():
+                    item = next(generator, _END)
+                    if item is _END:
+                        exhausted = True
+                        break
+                    job._push(item)
+            finally:
+                generator.close()
+        except Exception as e:
+            job.error = e
+
+        with self._lock:
+            self._running.remove(job)
+            self._threads.remove(threading.current_thread())
+            if job.error is not None:
+                job.state = Job.STATE_FAILED
+            elif exhausted:
+                job.state = Job.STATE_DONE
+            elif job._preempted and not job.cancelled:
+                job._reset()
+                heapq.heappush(self._queue, (job.priority, next(self._submit_order), job))
+            else:
+                job.state = Job.STATE_CANCELLED
+            if job.finished:
+                self._finished.append(job)
+            self._dispatch()